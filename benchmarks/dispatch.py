@@ -0,0 +1,98 @@
+"""Measure the per-request cost of dispatching a call through the ASGI app.
+
+The methods do no work and need no memcache round trip, so the timings are the
+overhead of parsing the request, decoding parameters and encoding the result.
+
+Usage: python benchmarks/dispatch.py
+"""
+
+import asyncio
+import time
+from typing import Any
+
+import msgspec
+
+from reproca.app import App
+from reproca.credentials import Credentials
+from reproca.memcache import Memcache
+from reproca.method import method
+from reproca.sessions import Sessions
+
+NUMBER = 100_000
+
+
+class Point(msgspec.Struct):
+    x: float
+    y: float
+
+
+@method
+async def ping() -> None:
+    pass
+
+
+@method
+async def add(a: int, b: int, c: int = 0) -> int:
+    return a + b + c
+
+
+@method
+async def centroid(points: list[Point]) -> Point:
+    return points[0]
+
+
+@method
+async def whoami(credentials: Credentials) -> str | None:
+    return credentials.get_session()
+
+
+CASES = [
+    ("ping", b"{}"),
+    ("add", b'{"a":1,"b":2}'),
+    ("centroid", b'{"points":[{"x":1.0,"y":2.0},{"x":3.0,"y":4.0}]}'),
+    ("whoami", b"{}"),
+]
+HEADERS = [
+    (b"host", b"localhost:8000"),
+    (b"origin", b"http://localhost:5173"),
+    (b"content-type", b"text/plain"),
+    (b"content-length", b"2"),
+    (b"cookie", b"sessionid=abcdefghijklmnopqrstuvwxyz; theme=dark; lang=en"),
+    (b"user-agent", b"Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/131.0"),
+]
+
+
+async def dispatch(app: App[Any, Any], path: str, body: bytes) -> float:
+    scope: Any = {
+        "type": "http",
+        "method": "POST",
+        "path": f"/{path}",
+        "query_string": b"",
+        "headers": HEADERS,
+        "client": ("127.0.0.1", 50000),
+    }
+    event = {"type": "http.request", "body": body, "more_body": False}
+
+    async def receive() -> Any:
+        return event
+
+    async def send(message: Any) -> None:
+        pass
+
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        await app(scope, receive, send)
+    return time.perf_counter() - start
+
+
+async def main() -> None:
+    memcache = Memcache(("127.0.0.1", 11211))
+    app: App[Any, Any] = App(Sessions[Any, Any](memcache), memcache)
+    print(f"{'method':<10}{'dispatch (us)':>14}")
+    for path, body in CASES:
+        elapsed = await dispatch(app, path, body)
+        print(f"{path:<10}{elapsed / NUMBER * 1e6:>14.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,286 @@
+"""Benchmark the request pipeline by calling the ASGI app in process.
+
+No server and no network are involved: requests are synthetic ASGI scopes and
+memcached is replaced by an in-memory stand-in which speaks the text protocol,
+so the client's serialization and reply parsing are still measured. With
+--backend local, the in-process backend replaces memcached altogether, and with
+--sessions signed, sessions are resolved from signed tokens.
+
+Usage:
+    python benchmarks/pipeline.py --output before.json
+    python benchmarks/pipeline.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any
+
+import msgspec
+
+from reproca.app import App
+from reproca.backend import Backend, LocalBackend
+from reproca.memcache import Memcache, Parser
+from reproca.method import method
+from reproca.rate_limit import FixedWindow
+from reproca.sessions import Sessions
+from reproca.signed_sessions import SignedSessions
+
+# The memcached stand-in is shared with the tests.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from tests.memcached import Memcached
+
+
+class MemoryMemcache(Memcache):
+    """A Memcache whose requests are answered by an in-memory memcached."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 11211))
+        self.memcached = Memcached()
+
+    async def execute(self, payload: bytes, parser: Parser | None) -> Any:
+        reply = self.memcached.reply(payload)
+        if parser is None:
+            return None
+        reader = asyncio.StreamReader()
+        reader.feed_data(reply)
+        reader.feed_eof()
+        return await parser(reader)
+
+
+class User(msgspec.Struct):
+    username: str
+    email: str
+
+
+class Address(msgspec.Struct):
+    street: str
+    city: str
+    country: str
+
+
+class Customer(msgspec.Struct):
+    name: str
+    email: str
+    tags: list[str]
+    addresses: list[Address]
+    scores: dict[str, float]
+
+
+class Row(msgspec.Struct):
+    id: int
+    title: str
+    done: bool
+
+
+ROWS = [Row(i, f"Todo number {i}", i % 2 == 0) for i in range(1000)]
+
+
+@method
+async def empty() -> None:
+    pass
+
+
+@method
+async def large_parameters(customers: list[Customer]) -> int:
+    return len(customers)
+
+
+@method
+async def authenticated(session: User) -> str:
+    return session.username
+
+
+@method(rate_limit=FixedWindow(10**9, 60))
+async def rate_limited() -> None:
+    pass
+
+
+@method
+async def large_response() -> list[Row]:
+    return ROWS
+
+
+CUSTOMER = Customer(
+    "Ada Lovelace",
+    "ada@example.com",
+    ["admin", "beta", "newsletter"],
+    [Address(f"{i} Analytical Engine Way", "London", "UK") for i in range(3)],
+    {"reputation": 98.5, "activity": 12.25},
+)
+SCENARIOS: dict[str, tuple[str, bytes]] = {
+    "empty": ("/empty", b"{}"),
+    "large_parameters": (
+        "/large_parameters",
+        msgspec.json.encode({"customers": [CUSTOMER] * 100}),
+    ),
+    "authenticated": ("/authenticated", b"{}"),
+    "rate_limited": ("/rate_limited", b"{}"),
+    "large_response": ("/large_response", b"{}"),
+}
+
+
+def request(path: str, body: bytes, cookie: bytes) -> tuple[Any, Any, Any]:
+    """Return a scope, a receive and a send callable for one request."""
+    scope: Any = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"localhost:8000"),
+            (b"origin", b"http://localhost:5173"),
+            (b"content-type", b"text/plain"),
+            (b"content-length", b"%d" % len(body)),
+            (b"cookie", cookie),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+    event = {"type": "http.request", "body": body, "more_body": False}
+
+    async def receive() -> Any:
+        return event
+
+    async def send(message: Any) -> None:
+        if message["type"] == "http.response.start" and message["status"] != 200:  # noqa: PLR2004
+            msg = f"{path} returned {message['status']}"
+            raise RuntimeError(msg)
+
+    return scope, receive, send
+
+
+async def run(
+    app: App[Any, Any], scope: Any, receive: Any, send: Any, number: int
+) -> list[int]:
+    latencies: list[int] = []
+    for _ in range(number):
+        start = time.perf_counter_ns()
+        await app(scope, receive, send)
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+
+async def benchmark(
+    app: App[Any, Any], scope: Any, receive: Any, send: Any, args: argparse.Namespace
+) -> dict[str, float]:
+    await run(app, scope, receive, send, args.warmup)
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            run(app, scope, receive, send, args.requests // args.concurrency)
+            for _ in range(args.concurrency)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for result in results for latency in result)
+    # CPython has no allocation counter, report the memory a request allocates
+    # at its peak and the memory it leaves allocated.
+    tracemalloc.start()
+    peak = retained = 0
+    for _ in range(args.traced):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await app(scope, receive, send)
+        after, traced_peak = tracemalloc.get_traced_memory()
+        peak += traced_peak - before
+        retained += after - before
+    tracemalloc.stop()
+    return {
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_us": latencies[len(latencies) // 2] / 1000,
+        "p99_us": latencies[len(latencies) * 99 // 100] / 1000,
+        "peak_bytes_per_request": peak / args.traced,
+        "retained_bytes_per_request": retained / args.traced,
+    }
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--traced", type=int, default=200)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--backend", choices=["memcache", "local"], default="memcache")
+    parser.add_argument(
+        "--sessions", choices=["memcache", "signed"], default="memcache"
+    )
+    parser.add_argument("--output", type=Path, help="save the results as JSON")
+    parser.add_argument("--compare", type=Path, help="JSON results to compare to")
+    args = parser.parse_args()
+
+    memcache: Backend = LocalBackend() if args.backend == "local" else MemoryMemcache()
+    # Parametrized so that sessions are decoded into User.
+    sessions = (
+        SignedSessions[int, User](memcache, key=b"benchmark" * 4)
+        if args.sessions == "signed"
+        else Sessions[int, User](memcache)
+    )
+    app: App[int, User] = App(sessions, memcache)
+    sessionid = await sessions.create(1, User("ada", "ada@example.com"))
+    cookie = f"sessionid={sessionid}; theme=dark".encode()
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+
+    results: dict[str, dict[str, float]] = {}
+    print(
+        f"{'scenario':<18}{'req/s':>10}{'p50 (us)':>10}{'p99 (us)':>10}"
+        f"{'peak (B)':>10}{'change':>9}"
+    )
+    for name in args.scenario or SCENARIOS:
+        path, body = SCENARIOS[name]
+        result = await benchmark(app, *request(path, body, cookie), args)
+        results[name] = result
+        change = ""
+        if baseline is not None and name in baseline["results"]:
+            previous = baseline["results"][name]["requests_per_second"]
+            change = f"{result['requests_per_second'] / previous - 1:+.1%}"
+        print(
+            f"{name:<18}{result['requests_per_second']:>10.0f}"
+            f"{result['p50_us']:>10.1f}{result['p99_us']:>10.1f}"
+            f"{result['peak_bytes_per_request']:>10.0f}{change:>9}"
+        )
+    if args.output:
+        args.output.write_text(
+            json.dumps(
+                {
+                    "commit": commit(),
+                    "python": platform.python_version(),
+                    "requests": args.requests,
+                    "concurrency": args.concurrency,
+                    "backend": args.backend,
+                    "sessions": args.sessions,
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
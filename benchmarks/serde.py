@@ -0,0 +1,49 @@
+"""Compare the memcache serdes on a typical session value.
+
+Usage: python benchmarks/serde.py
+"""
+
+from datetime import UTC, datetime
+from functools import partial
+from timeit import timeit
+
+import msgspec
+
+from reproca.serde import MsgpackSerde, PickleSerde
+from reproca.sessions import Session
+
+
+class User(msgspec.Struct):
+    username: str
+    email: str
+    roles: list[str]
+
+
+NUMBER = 100_000
+TYPE = Session[int, User]
+VALUE = TYPE(
+    1234,
+    User("aspizu", "aspizu@protonmail.com", ["admin", "user"]),
+    datetime.now(tz=UTC),
+)
+
+
+def main() -> None:
+    print(f"{'serde':<14}{'encode (us)':>12}{'decode (us)':>12}{'size (B)':>10}")
+    for serde in (PickleSerde(), MsgpackSerde()):
+        data, flags = serde.serialize("key", VALUE)
+        assert serde.deserialize("key", data, flags, TYPE) == VALUE
+        encode = timeit(partial(serde.serialize, "key", VALUE), number=NUMBER)
+        decode = timeit(
+            partial(serde.deserialize, "key", data, flags, TYPE), number=NUMBER
+        )
+        print(
+            f"{type(serde).__name__:<14}"
+            f"{encode / NUMBER * 1e6:>12.3f}"
+            f"{decode / NUMBER * 1e6:>12.3f}"
+            f"{len(data):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,48 @@ export type MethodResult<T> = Result<T, Error>;
 export declare class ProtocolError extends Error {
 }
 export type Middleware = <T>(result: () => Promise<MethodResult<T>>) => Promise<MethodResult<T>>;
+export interface AppOptions {
+    /** Coalesce calls made in the same tick into one request to the batch route. */
+    batch?: boolean;
+    /** Path of the batch route on the server. */
+    batchPath?: string;
+    /** Multiplex calls over a persistent WebSocket instead of one request each. */
+    websocket?: boolean;
+    /** Path of the WebSocket route on the server. */
+    websocketPath?: string;
+    /**
+     * Give up on HTTP calls after this many milliseconds. The server is told
+     * the deadline and stops working on calls nobody waits for anymore.
+     */
+    timeout?: number;
+}
+interface PendingCall {
+    name: string;
+    parameters: unknown;
+    resolve: (result: MethodResult<any>) => void;
+}
+interface Connection {
+    socket: WebSocket;
+    calls: Map<number, PendingCall>;
+}
 export declare class App<M> {
     host: string;
     middleware?: Middleware | undefined;
-    constructor(host: string, middleware?: Middleware | undefined);
+    options: AppOptions;
+    queue: PendingCall[];
+    connection?: Promise<Connection>;
+    nextId: number;
+    constructor(host: string, middleware?: Middleware | undefined, options?: AppOptions);
     method<T, R>(name: string, parameters: T): Promise<MethodResult<R>>;
+    /** Call a method which consumes the request body as a stream. */
+    upload<T, R>(name: string, body: BodyInit, parameters: T): Promise<MethodResult<R>>;
+    /** Call a method which streams its result as newline-delimited JSON. */
+    stream<T, R>(name: string, parameters: T): AsyncIterable<R>;
     _method<T, R>(name: string, parameters: T): Promise<MethodResult<R>>;
+    _fetch<T, R>(name: string, parameters: T, body?: BodyInit): Promise<MethodResult<R>>;
+    _flush(): Promise<void>;
+    _result<R>(name: string, status: number, value: any): MethodResult<R>;
+    _send<T, R>(name: string, parameters: T): Promise<MethodResult<R>>;
+    _connect(): Promise<Connection>;
 }
+export {};
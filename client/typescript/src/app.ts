@@ -8,8 +8,52 @@ export type Middleware = <T>(
     result: () => Promise<MethodResult<T>>
 ) => Promise<MethodResult<T>>
 
+export interface AppOptions {
+    /** Coalesce calls made in the same tick into one request to the batch route. */
+    batch?: boolean
+    /** Path of the batch route on the server. */
+    batchPath?: string
+    /** Multiplex calls over a persistent WebSocket instead of one request each. */
+    websocket?: boolean
+    /** Path of the WebSocket route on the server. */
+    websocketPath?: string
+    /**
+     * Give up on HTTP calls after this many milliseconds. The server is told
+     * the deadline and stops working on calls nobody waits for anymore.
+     */
+    timeout?: number
+}
+
+interface PendingCall {
+    name: string
+    parameters: unknown
+    resolve: (result: MethodResult<any>) => void
+}
+
+interface BatchResult {
+    status: number
+    value: any
+}
+
+interface WebSocketResult extends BatchResult {
+    id: number
+}
+
+interface Connection {
+    socket: WebSocket
+    calls: Map<number, PendingCall>
+}
+
 export class App<M> {
-    constructor(public host: string, public middleware?: Middleware) {}
+    queue: PendingCall[] = []
+    connection?: Promise<Connection>
+    nextId = 0
+
+    constructor(
+        public host: string,
+        public middleware?: Middleware,
+        public options: AppOptions = {}
+    ) {}
 
     async method<T, R>(name: string, parameters: T): Promise<MethodResult<R>> {
         const result = () => this._method<T, R>(name, parameters)
@@ -19,21 +63,99 @@ export class App<M> {
         return result()
     }
 
+    /** Call a method which consumes the request body as a stream. */
+    async upload<T, R>(
+        name: string,
+        body: BodyInit,
+        parameters: T
+    ): Promise<MethodResult<R>> {
+        const result = () =>
+            this._fetch<T, R>(
+                `${name}?${encodeURIComponent(JSON.stringify(parameters))}`,
+                parameters,
+                body
+            )
+        if (this.middleware) {
+            return this.middleware(result)
+        }
+        return result()
+    }
+
+    /** Call a method which streams its result as newline-delimited JSON. */
+    async *stream<T, R>(name: string, parameters: T): AsyncIterable<R> {
+        const result = await fetch(`${this.host}/${name}`, {
+            method: "POST",
+            headers: {"Content-Type": "text/plain"}, // simple request
+            body: JSON.stringify(parameters),
+            credentials: "include",
+        })
+        if (!result.ok || !result.body) {
+            const body = await result.text()
+            throw new ProtocolError(
+                `Server returned ${result.statusText}${
+                    body && ` (${body})`
+                } while calling method \`${name}\``
+            )
+        }
+        const reader = result.body.pipeThrough(new TextDecoderStream()).getReader()
+        let buffer = ""
+        for (;;) {
+            const {done, value} = await reader.read()
+            if (done) {
+                break
+            }
+            const lines = (buffer + value).split("\n")
+            buffer = lines.pop()!
+            for (const line of lines) {
+                yield JSON.parse(line)
+            }
+        }
+        if (buffer) {
+            yield JSON.parse(buffer)
+        }
+    }
+
     async _method<T, R>(name: string, parameters: T): Promise<MethodResult<R>> {
+        if (this.options.websocket) {
+            return this._send(name, parameters)
+        }
+        if (this.options.batch) {
+            return new Promise((resolve) => {
+                if (this.queue.push({name, parameters, resolve}) === 1) {
+                    setTimeout(() => this._flush(), 0)
+                }
+            })
+        }
+        return this._fetch(name, parameters)
+    }
+
+    async _fetch<T, R>(
+        name: string,
+        parameters: T,
+        body: BodyInit = JSON.stringify(parameters)
+    ): Promise<MethodResult<R>> {
+        const headers: Record<string, string> = {"Content-Type": "text/plain"}
+        const {timeout} = this.options
+        if (timeout !== undefined) {
+            // Not a simple request anymore, the server answers the preflight.
+            headers["Reproca-Timeout"] = String(timeout)
+        }
         try {
             let result = await fetch(`${this.host}/${name}`, {
                 method: "POST",
-                headers: {"Content-Type": "text/plain"}, // simple request
-                body: JSON.stringify(parameters),
+                headers,
+                body,
                 credentials: "include",
+                signal:
+                    timeout === undefined ? undefined : AbortSignal.timeout(timeout),
             })
             if (result.ok) {
                 return {ok: true, value: await result.json()}
             }
-            const body = await result.text()
+            const text = await result.text()
             throw new ProtocolError(
                 `Server returned ${result.statusText}${
-                    body && ` (${body})`
+                    text && ` (${text})`
                 } while calling method \`${name}\``
             )
         } catch (err) {
@@ -43,4 +165,109 @@ export class App<M> {
             throw err
         }
     }
+
+    async _flush(): Promise<void> {
+        const calls = this.queue
+        this.queue = []
+        if (calls.length === 1) {
+            const [call] = calls
+            call.resolve(await this._fetch(call.name, call.parameters))
+            return
+        }
+        const result = await this._fetch<unknown, BatchResult[]>(
+            (this.options.batchPath ?? "/_batch").replace(/^\//, ""),
+            calls.map(({name, parameters}) => ({method: name, parameters}))
+        )
+        calls.forEach((call, index) => {
+            if (!result.ok) {
+                call.resolve(result)
+                return
+            }
+            const {status, value} = result.value[index]
+            call.resolve(this._result(call.name, status, value))
+        })
+    }
+
+    _result<R>(name: string, status: number, value: any): MethodResult<R> {
+        if (status === 200) {
+            return {ok: true, value}
+        }
+        return {
+            ok: false,
+            value: new ProtocolError(
+                `Server returned status ${status}${
+                    value && ` (${value})`
+                } while calling method \`${name}\``
+            ),
+        }
+    }
+
+    async _send<T, R>(name: string, parameters: T): Promise<MethodResult<R>> {
+        let connection: Connection
+        try {
+            connection = await this._connect()
+        } catch (err) {
+            if (err instanceof Error) {
+                return {ok: false, value: err}
+            }
+            throw err
+        }
+        const id = this.nextId++
+        return new Promise((resolve) => {
+            connection.calls.set(id, {name, parameters, resolve})
+            connection.socket.send(JSON.stringify({id, method: name, parameters}))
+        })
+    }
+
+    _connect(): Promise<Connection> {
+        if (this.connection) {
+            return this.connection
+        }
+        const connection = new Promise<Connection>((resolve, reject) => {
+            const socket = new WebSocket(
+                this.host.replace(/^http/, "ws") +
+                    (this.options.websocketPath ?? "/_websocket")
+            )
+            const calls = new Map<number, PendingCall>()
+            socket.onopen = () => resolve({socket, calls})
+            socket.onmessage = async (event) => {
+                const {id, status, value}: WebSocketResult = JSON.parse(event.data)
+                const call = calls.get(id)
+                if (!call) {
+                    return
+                }
+                calls.delete(id)
+                if (status === 426) {
+                    // The method needs a request of its own, e.g. to set cookies.
+                    // Reconnect afterwards so that new calls see the new cookies.
+                    if (this.connection === connection) {
+                        this.connection = undefined
+                    }
+                    call.resolve(await this._fetch(call.name, call.parameters))
+                } else {
+                    call.resolve(this._result(call.name, status, value))
+                }
+                if (this.connection !== connection && calls.size === 0) {
+                    socket.close()
+                }
+            }
+            socket.onclose = () => {
+                if (this.connection === connection) {
+                    this.connection = undefined
+                }
+                reject(new ProtocolError("Could not connect to the WebSocket"))
+                for (const call of calls.values()) {
+                    call.resolve({
+                        ok: false,
+                        value: new ProtocolError(
+                            `WebSocket closed while calling method \`${call.name}\``
+                        ),
+                    })
+                }
+                calls.clear()
+            }
+        })
+        this.connection = connection
+        return connection
+    }
 }
@@ -0,0 +1,9 @@
+import {App, type MethodResult} from "reproca/app"
+import {circuitBreakerMiddleware} from "~/query"
+const app = new App(
+    import.meta.env.VITE_API,
+    circuitBreakerMiddleware({
+        maxFailures: 3,
+        resetTimeout: 15000
+    })
+)
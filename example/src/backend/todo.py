@@ -1,12 +1,13 @@
 from msgspec import UNSET, UnsetType
 from reproca.method import method
+from reproca.result_cache import MemcacheCache
 
 from .models import Todo
 
 todos: list[Todo] = []
 
 
-@method
+@method(invalidates=["todos"])
 async def create_todo(title: str, description: str) -> str:
     """Create a new todo item with the given title and description.
 
@@ -29,12 +30,12 @@ async def create_todo(title: str, description: str) -> str:
     return todo.id
 
 
-@method
+@method(cache=MemcacheCache(ttl=300), tags=["todos"])
 async def get_todos() -> list[Todo]:
     return todos
 
 
-@method
+@method(invalidates=["todos"])
 async def update_todo(
     todo_id: str,
     title: str | UnsetType = UNSET,
@@ -52,7 +53,7 @@ async def update_todo(
         todo.done = done
 
 
-@method
+@method(invalidates=["todos"])
 async def delete_todo(todo_id: str) -> None:
     todo_index = next(
         (index for index, todo in enumerate(todos) if todo.id == todo_id), None
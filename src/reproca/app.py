@@ -1,31 +1,60 @@
-from collections.abc import Sequence
+import asyncio
+import logging
+from collections.abc import AsyncIterator, Awaitable, Callable, Sequence
+from functools import partial
 from http import HTTPStatus
+from time import perf_counter_ns
+from typing import Any
+from urllib.parse import unquote_to_bytes
 
 import msgspec.json
 
 from .asgi.types import (
     ASGIReceiveCallable,
     ASGISendCallable,
-    HTTPDisconnectEvent,
-    HTTPRequestEvent,
     HTTPScope,
+    LifespanScope,
     LifespanShutdownEvent,
     LifespanStartupEvent,
     Scope,
     WebSocketConnectEvent,
     WebSocketDisconnectEvent,
     WebSocketReceiveEvent,
+    WebSocketScope,
 )
+from .backend import Backend
+from .compression import Compressor, negotiate
+from .concurrency import OverloadedError, Scheduler, hold
 from .credentials import Credentials
-from .memcache import Memcache
-from .method import methods
-from .sessions import Sessions
+from .executors import Executors
+from .method import Method, methods
+from .metrics import Metrics
+from .result_cache import format_tags, generations, invalidate
+from .serde import MsgpackSerde
+from .sessions import SessionStore
+from .streams import (
+    BodyTooLargeError,
+    DisconnectedError,
+    RequestBody,
+    ndjson,
+    read_body,
+)
+from .tracing import Trace, Tracer
 
+logger = logging.getLogger(__name__)
 encoder = msgspec.json.Encoder()
+# The status recorded for calls cancelled because the client disconnected.
+CLIENT_CLOSED_REQUEST = 499
+# How often calls which are still running start watching for the client to
+# disconnect, most calls complete sooner and never pay for a watching task.
+SWEEP_INTERVAL = 0.01
+
+type Hook = Callable[[], Awaitable[None]]
 
 
-def get_headers(scope: HTTPScope) -> dict[bytes, bytes]:
-    return {key.lower(): value for key, value in scope["headers"]}
+def get_headers(scope: HTTPScope | WebSocketScope) -> dict[bytes, bytes]:
+    # Header names are lowercased by the server.
+    return dict(scope["headers"])
 
 
 async def send_response_header(
@@ -46,14 +75,229 @@ async def send_response(body: bytes, send: ASGISendCallable) -> None:
     await send({"type": "http.response.body", "body": body})
 
 
+class BatchCall(msgspec.Struct):
+    method: str
+    parameters: msgspec.Raw = msgspec.Raw(b"{}")
+
+
+class BatchResult(msgspec.Struct):
+    status: int
+    value: msgspec.Raw
+
+
+batch_decoder = msgspec.json.Decoder(list[BatchCall])
+
+
+class Context[T, U]:
+    """State shared by all method calls made in one request or on one WebSocket."""
+
+    def __init__(
+        self, sessions: SessionStore[U], address: str, credentials: Credentials
+    ) -> None:
+        self.sessions = sessions
+        self.address = address
+        self.credentials = credentials
+        self._session: asyncio.Task[U | None] | None = None
+        # The Content-Encoding the client accepts and the one of the body, set
+        # when a cached compressed body is returned.
+        self.accept_encoding: str | None = None
+        self.content_encoding: str | None = None
+        self.request_size = 0
+        self.trace: Trace | None = None
+        # Seconds after which a call rejected to shed load may be retried.
+        self.retry_after: int | None = None
+        # Waits for the client to disconnect, and whether it did.
+        self.watcher: asyncio.Task[None] | None = None
+        self.disconnected = False
+
+    async def load_session(self) -> U | None:
+        trace = self.trace
+        mark = perf_counter_ns() if trace is not None else 0
+        sessionid = self.credentials.get_session()
+        if trace is not None:
+            mark = trace.add("cookies", mark)
+        if not sessionid:
+            return None
+        session = await self.sessions.get_by_sessionid(sessionid)
+        if trace is not None:
+            trace.add("session", mark)
+        return session
+
+    def prefetch_session(self) -> None:
+        if self._session is None:
+            self._session = asyncio.create_task(self.load_session())
+
+    async def session(self) -> U | None:
+        """Resolve the session once, even if several calls need it concurrently."""
+        self.prefetch_session()
+        assert self._session is not None
+        return await self._session
+
+
+class WebSocketCall(msgspec.Struct):
+    id: int
+    method: str
+    parameters: msgspec.Raw = msgspec.Raw(b"{}")
+
+
+class WebSocketResult(msgspec.Struct):
+    id: int
+    status: int
+    value: msgspec.Raw
+
+
+websocket_decoder = msgspec.json.Decoder(WebSocketCall)
+
+
+class WebSocketConnection[T, U]:
+    """A WebSocket over which method calls are multiplexed.
+
+    Every frame is a call with an id, calls run concurrently and their results
+    are sent back with the same id as soon as they complete.
+    """
+
+    def __init__(
+        self, context: Context[T, U], send: ASGISendCallable, max_calls: int
+    ) -> None:
+        self.context = context
+        self.send = send
+        self.lock = asyncio.Lock()
+        self.slots = asyncio.Semaphore(max_calls)
+        self.tasks: set[asyncio.Task[None]] = set()
+        self.closed = False
+
+    async def reply(self, result: WebSocketResult) -> None:
+        text = encoder.encode(result).decode()
+        async with self.lock:
+            # Calls completing after the close have nobody to reply to.
+            if not self.closed:
+                await self.send({"type": "websocket.send", "text": text})
+
+    async def close(self, code: int) -> None:
+        async with self.lock:
+            if not self.closed:
+                self.closed = True
+                await self.send({"type": "websocket.close", "code": code})
+
+    async def cancel(self) -> None:
+        """Cancel the calls in flight and wait until they are done."""
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 class App[T, U]:
     def __init__(
         self,
-        sessions: Sessions[T, U],
-        memcache: Memcache,
+        sessions: SessionStore[U],
+        memcache: Backend,
+        batch_path: str = "/_batch",
+        max_batch_size: int = 64,
+        max_body_size: int = 1048576,
+        websocket_path: str = "/_websocket",
+        max_websocket_calls: int = 64,
+        shutdown_timeout: float = 30.0,
+        compression_threshold: int | None = 1024,
+        compression_level: int = 6,
+        metrics: Metrics | None = None,
+        metrics_path: str | None = "/_metrics",
+        tracer: Tracer | None = None,
+        executors: Executors | None = None,
+        scheduler: Scheduler | None = None,
     ) -> None:
+        """Initialize a reproca ASGI application.
+
+        Args:
+        ----
+            sessions: The sessions manager, Sessions or SignedSessions.
+            memcache: The memcache client or another backend, used for rate
+                limiting, result caching and cache invalidation.
+            batch_path: The route accepting an array of method calls.
+            max_batch_size: The maximum number of calls in one batch.
+            max_body_size: The default maximum request body size in bytes.
+            websocket_path: The route accepting WebSocket connections.
+            max_websocket_calls: The maximum number of calls in flight on one
+                WebSocket, further frames are not read until one completes.
+            shutdown_timeout: Seconds to wait for in-flight calls on shutdown.
+            compression_threshold: The minimum response size in bytes compressed
+                with gzip or deflate if the client accepts it, None disables
+                compression. Streamed responses are always compressed.
+            compression_level: The zlib compression level.
+            metrics: Where per-method metrics are recorded, in memory for this
+                process by default.
+            metrics_path: The route serving the metrics in the Prometheus text
+                format, None disables it.
+            tracer: Times the phases of sampled requests, None disables tracing.
+            executors: The pools running methods registered with an executor,
+                their queue depths are reported with the metrics.
+            scheduler: Admits method calls by priority class once this worker
+                runs its maximum number of calls, None admits them at once.
+
+        """
         self.memcache = memcache
         self.sessions = sessions
+        # Raise now rather than on every request if it can't decode sessions.
+        _ = sessions.session_type
+        self.batch_path = batch_path
+        self.max_batch_size = max_batch_size
+        self.max_body_size = max_body_size
+        self.websocket_path = websocket_path
+        self.max_websocket_calls = max_websocket_calls
+        self.shutdown_timeout = shutdown_timeout
+        self.compression_threshold = compression_threshold
+        self.compressor = Compressor(compression_level)
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics.add_path(batch_path)
+        self.metrics_path = metrics_path
+        self.tracer = tracer
+        self.executors = Executors() if executors is None else executors
+        self.metrics.add_gauge(
+            "reproca_executor_queue_depth",
+            "Calls waiting for a free worker of a pool in this process.",
+            lambda: {
+                f'executor="{kind}"': self.executors.queue_depth(kind)
+                for kind in self.executors.sizes
+            },
+        )
+        self.scheduler = scheduler
+        if scheduler is not None:
+            self.metrics.add_gauge(
+                "reproca_scheduler_queue_depth",
+                "Calls waiting for the scheduler to admit them in this process.",
+                lambda: {"": len(scheduler.waiters)},
+            )
+        self.startup_hooks: list[Hook] = []
+        self.shutdown_hooks: list[Hook] = []
+        self.accepting = True
+        self.inflight: set[asyncio.Future[None]] = set()
+        # Requests which cancel on disconnection, with the sweep they started in.
+        self.watched: dict[
+            asyncio.Task[Any], tuple[ASGIReceiveCallable, Context[T, U], int]
+        ] = {}
+        self.sweeps = 0
+        self.sweeper: asyncio.Task[None] | None = None
+        self.websockets: set[WebSocketConnection[T, U]] = set()
+
+    def startup_hook[H: Hook](self, hook: H) -> H:
+        """Register a coroutine function to run before the app accepts traffic.
+
+        Usage:
+        >>> @app.startup_hook
+        ... async def load_config() -> None: ...
+        """
+        self.startup_hooks.append(hook)
+        return hook
+
+    def shutdown_hook[H: Hook](self, hook: H) -> H:
+        """Register a coroutine function to run once in-flight calls are drained."""
+        self.shutdown_hooks.append(hook)
+        return hook
+
+    def track(self, task: asyncio.Future[None]) -> None:
+        """Count a task as in flight until it is done, shutdown waits for it."""
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
 
     async def __call__(
         self,
@@ -61,127 +305,715 @@ class App[T, U]:
         receive: ASGIReceiveCallable,
         send: ASGISendCallable,
     ) -> None:
-        request = await receive()
-        match request["type"]:
-            case "http.request":
-                assert scope["type"] == "http"
-                await self.on_request(scope, request, send)
-            case "http.disconnect":
-                await self.on_disconnect(scope, request, send)
-            case "lifespan.startup":
-                await self.on_startup(scope, request, send)
-            case "lifespan.shutdown":
-                await self.on_shutdown(scope, request, send)
-            case "websocket.connect":
-                await self.on_websocket_connect(scope, request, send)
-            case "websocket.receive":
-                await self.on_websocket_receive(scope, request, send)
-            case "websocket.disconnect":
-                await self.on_websocket_disconnect(scope, request, send)
+        if scope["type"] == "http":
+            await self.on_request(scope, receive, send)
+            return
+        if scope["type"] == "websocket":
+            await self.on_websocket(scope, receive, send)
+            return
+        await self.on_lifespan(scope, receive, send)
 
     async def on_request(
         self,
         scope: HTTPScope,
-        event: HTTPRequestEvent,
+        receive: ASGIReceiveCallable,
         send: ASGISendCallable,
     ) -> None:
+        if scope["path"] == self.metrics_path:
+            await send_response_header(
+                HTTPStatus.OK,
+                send,
+                headers=[(b"Content-Type", b"text/plain; version=0.0.4")],
+            )
+            await send_response(self.metrics.render(), send)
+            return
         headers = get_headers(scope)
         response_headers = [
             # Bypass CORS, could be dangerous?
             (b"Access-Control-Allow-Origin", headers[b"origin"]),
             (b"Access-Control-Allow-Credentials", b"true"),
-            (b"Content-Type", b"application/json"),
         ]
-        assert scope["client"] is not None
-        address = scope["client"][0]
-        try:
-            method = methods[scope["path"]]
-        except KeyError:
+        if scope["method"] == "OPTIONS":
+            # Calls with a deadline are not simple requests, allow the header.
+            response_headers += [
+                (b"Access-Control-Allow-Methods", b"POST"),
+                (b"Access-Control-Allow-Headers", b"Content-Type, Reproca-Timeout"),
+                (b"Access-Control-Max-Age", b"86400"),
+            ]
             await send_response_header(
-                HTTPStatus.BAD_REQUEST, send, headers=response_headers
+                HTTPStatus.NO_CONTENT, send, headers=response_headers
             )
-            await send_response(b"Method does not exist", send)
+            await send_response(b"", send)
             return
-        if method.rate_limit > 0 and self.memcache.rate_limit(
-            address, scope["path"], method.rate_limit
-        ):
+        if not self.accepting:
+            response_headers.append((b"Connection", b"close"))
             await send_response_header(
-                HTTPStatus.TOO_MANY_REQUESTS, send, headers=response_headers
+                HTTPStatus.SERVICE_UNAVAILABLE, send, headers=response_headers
             )
-            await send_response(b"Rate limit exceeded", send)
+            await send_response(b"Server is shutting down", send)
             return
+        task = asyncio.current_task()
+        assert task is not None
+        self.inflight.add(task)
         try:
-            parameters = method.decoder.decode(event["body"])
-        except (msgspec.DecodeError, msgspec.ValidationError):
-            await send_response_header(
-                HTTPStatus.BAD_REQUEST, send, headers=response_headers
+            await self.respond(scope, headers, response_headers, receive, send)
+        finally:
+            self.inflight.discard(task)
+
+    async def respond(
+        self,
+        scope: HTTPScope,
+        headers: dict[bytes, bytes],
+        response_headers: list[tuple[bytes, bytes]],
+        receive: ASGIReceiveCallable,
+        send: ASGISendCallable,
+    ) -> None:
+        start = perf_counter_ns()
+        assert scope["client"] is not None
+        credentials = Credentials(headers.get(b"cookie", None))
+        context = Context(self.sessions, scope["client"][0], credentials)
+        method = methods.get(scope["path"])
+        if self.compression_threshold is not None:
+            response_headers.append((b"Vary", b"Accept-Encoding"))
+            if method is None or method.compress:
+                context.accept_encoding = negotiate(headers.get(b"accept-encoding"))
+        if self.tracer is not None:
+            context.trace = trace = self.tracer.start(headers)
+        else:
+            trace = None
+        try:
+            status, body = await self.handle_within_deadline(
+                scope, headers, receive, context
+            )
+        except (DisconnectedError, asyncio.CancelledError) as e:
+            if isinstance(e, asyncio.CancelledError):
+                if not context.disconnected:
+                    raise
+                task = asyncio.current_task()
+                assert task is not None
+                task.uncancel()
+            self.metrics.record(
+                scope["path"],
+                CLIENT_CLOSED_REQUEST,
+                context.request_size,
+                0,
+                perf_counter_ns() - start,
             )
-            await send_response(b"Invalid parameters", send)
             return
-        args = msgspec.structs.asdict(parameters)
-        credentials = Credentials(headers.get(b"cookie", None))
-        if "credentials" in method.type_hints:
-            args["credentials"] = credentials
-        if "session" in method.type_hints:
-            args["session"] = None
-            if sessionid := credentials.get_session():
-                args["session"] = self.sessions.get_by_sessionid(sessionid)
-            if not method.parameter_session_optional and args["session"] is None:
-                await send_response_header(
-                    HTTPStatus.UNAUTHORIZED, send, headers=response_headers
+        except Exception:
+            self.metrics.record(
+                scope["path"],
+                HTTPStatus.INTERNAL_SERVER_ERROR,
+                context.request_size,
+                0,
+                perf_counter_ns() - start,
+            )
+            raise
+        response_headers.extend(credentials._headers)
+        if context.retry_after is not None:
+            response_headers.append((b"Retry-After", b"%d" % context.retry_after))
+        encoding = context.accept_encoding
+        if isinstance(body, bytes):
+            if encoding is not None and context.content_encoding is None:
+                mark = perf_counter_ns() if trace is not None else 0
+                compressed = self.compress(body, encoding)
+                if compressed is not None:
+                    body = compressed
+                    context.content_encoding = encoding
+                    if trace is not None:
+                        trace.add("compress", mark)
+            if context.content_encoding is not None:
+                response_headers.append(
+                    (b"Content-Encoding", context.content_encoding.encode())
                 )
-                await send_response(b"Invalid session", send)
-                return
-        body = encoder.encode(await method.implementation(**args))
-        if "credentials" in method.type_hints:
-            response_headers.extend(credentials._headers)
-        await send_response_header(HTTPStatus.OK, send, headers=response_headers)
-        await send_response(body, send)
+            response_headers.append((b"Content-Type", b"application/json"))
+            if trace is not None:
+                self.add_server_timing(trace, start, response_headers)
+            await send_response_header(status, send, headers=response_headers)
+            await send_response(body, send)
+            self.metrics.record(
+                scope["path"],
+                status,
+                context.request_size,
+                len(body),
+                perf_counter_ns() - start,
+            )
+            if trace is not None:
+                self.finish_trace(scope["path"], trace)
+            return
+        if encoding is not None:
+            body = self.compressor.stream(body, encoding)
+            response_headers.append((b"Content-Encoding", encoding.encode()))
+        response_headers.append((b"Content-Type", b"application/x-ndjson"))
+        if trace is not None:
+            self.add_server_timing(trace, start, response_headers)
+        await send_response_header(status, send, headers=response_headers)
+        size = 0
+        async for chunk in body:
+            size += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send_response(b"", send)
+        self.metrics.record(
+            scope["path"], status, context.request_size, size, perf_counter_ns() - start
+        )
+        if trace is not None:
+            self.finish_trace(scope["path"], trace)
 
-    async def on_disconnect(
+    def add_server_timing(
         self,
-        scope: Scope,
-        event: HTTPDisconnectEvent,
+        trace: Trace,
+        start: int,
+        response_headers: list[tuple[bytes, bytes]],
+    ) -> None:
+        """Close the trace's "total" span and report the spans in a header."""
+        assert self.tracer is not None
+        trace.add("total", start)
+        if self.tracer.server_timing:
+            response_headers.append((b"Server-Timing", trace.server_timing()))
+
+    def finish_trace(self, path: str, trace: Trace) -> None:
+        assert self.tracer is not None
+        try:
+            self.tracer.finish(path, trace)
+        except Exception:
+            logger.exception("Span hook raised an exception")
+
+    async def handle_within_deadline(
+        self,
+        scope: HTTPScope,
+        headers: dict[bytes, bytes],
+        receive: ASGIReceiveCallable,
+        context: Context[T, U],
+    ) -> tuple[HTTPStatus, bytes | AsyncIterator[bytes]]:
+        """Handle a request, cancel it once the client's deadline has passed.
+
+        The Reproca-Timeout header holds the milliseconds the client waits for
+        the response, counted from when the request is received to not depend
+        on clocks being in sync.
+        """
+        value = headers.get(b"reproca-timeout")
+        if value is None:
+            return await self.handle_request(scope, headers, receive, context)
+        try:
+            timeout = int(value) / 1000
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, b"Invalid Reproca-Timeout"
+        deadline = asyncio.timeout(timeout)
+        try:
+            async with deadline:
+                return await self.handle_request(scope, headers, receive, context)
+        except TimeoutError:
+            if not deadline.expired():
+                raise
+            return HTTPStatus.GATEWAY_TIMEOUT, b"Deadline exceeded"
+
+    async def handle_request(
+        self,
+        scope: HTTPScope,
+        headers: dict[bytes, bytes],
+        receive: ASGIReceiveCallable,
+        context: Context[T, U],
+    ) -> tuple[HTTPStatus, bytes | AsyncIterator[bytes]]:
+        """Read the request body within the method's size limit and call it."""
+        method = methods.get(scope["path"])
+        limit = self.max_body_size
+        if method is not None and method.max_body_size is not None:
+            limit = method.max_body_size
+        try:
+            content_length = int(headers[b"content-length"])
+        except KeyError:
+            content_length = None
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, b"Invalid Content-Length"
+        if content_length is not None and content_length > limit:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"Request body is too large"
+        if method is not None and method.body_parameter is not None:
+            stream = RequestBody(receive, limit)
+            try:
+                return await self.call(
+                    scope["path"],
+                    unquote_to_bytes(scope["query_string"]) or b"{}",
+                    context,
+                    stream,
+                )
+            finally:
+                context.request_size = stream.received
+        trace = context.trace
+        mark = perf_counter_ns() if trace is not None else 0
+        try:
+            body = await read_body(receive, content_length, limit)
+        except BodyTooLargeError:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"Request body is too large"
+        if trace is not None:
+            trace.add("read", mark)
+        context.request_size = len(body)
+        task = asyncio.current_task()
+        assert task is not None
+        self.watched[task] = (receive, context, self.sweeps)
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self.sweep())
+        try:
+            if scope["path"] == self.batch_path:
+                return await self.batch(body, context)
+            return await self.call(
+                scope["path"], body, context, encoding=context.accept_encoding
+            )
+        finally:
+            del self.watched[task]
+            if context.watcher is not None:
+                context.watcher.cancel()
+
+    async def sweep(self) -> None:
+        """Watch for disconnections of the clients of calls running for a while."""
+        try:
+            while self.watched:
+                await asyncio.sleep(SWEEP_INTERVAL)
+                self.sweeps += 1
+                for task, (receive, context, sweeps) in list(self.watched.items()):
+                    # Running for at least one whole interval.
+                    if context.watcher is None and sweeps < self.sweeps - 1:
+                        context.watcher = asyncio.create_task(
+                            self.watch_disconnect(receive, context, task)
+                        )
+        finally:
+            self.sweeper = None
+
+    async def watch_disconnect(
+        self,
+        receive: ASGIReceiveCallable,
+        context: Context[T, U],
+        task: asyncio.Task[Any],
+    ) -> None:
+        """Cancel a request if the client disconnects while it is handled."""
+        # Once the body is read, the next event can only be the disconnection.
+        event = await receive()
+        if event["type"] == "http.disconnect":
+            self.on_disconnect(context, task)
+
+    async def call(
+        self,
+        path: str,
+        body: bytes | bytearray,
+        context: Context[T, U],
+        stream: RequestBody | None = None,
+        *,
+        encoding: str | None = None,
+    ) -> tuple[HTTPStatus, bytes | AsyncIterator[bytes]]:
+        """Call a method, return the response status and body.
+
+        `stream` is the request body for methods which consume it as a stream, their
+        parameters are then decoded from `body`. The response body of methods which
+        stream their result is an async iterator of newline-delimited JSON chunks.
+
+        A cached result is returned compressed with `encoding` if it is large
+        enough, the compressed body is cached too and `context.content_encoding`
+        is set.
+        """
+        try:
+            method = methods[path]
+        except KeyError:
+            return HTTPStatus.BAD_REQUEST, b"Method does not exist"
+        trace = context.trace
+        mark = perf_counter_ns() if trace is not None else 0
+        if method.rate_limit is not None:
+            exceeded = await self.memcache.rate_limit(
+                context.address, path, method.rate_limit
+            )
+            if trace is not None:
+                mark = trace.add("rate_limit", mark)
+            if exceeded:
+                return HTTPStatus.TOO_MANY_REQUESTS, b"Rate limit exceeded"
+        parameters = None
+        if method.has_parameters:
+            try:
+                parameters = method.decoder.decode(body)
+            except (msgspec.DecodeError, msgspec.ValidationError):
+                return HTTPStatus.BAD_REQUEST, b"Invalid parameters"
+            if trace is not None:
+                trace.add("decode", mark)
+        if method.body_parameter is not None and stream is None:
+            return HTTPStatus.BAD_REQUEST, b"Method requires a streamed body"
+        session = None
+        if method.uses_session:
+            session = await context.session()
+            if session is None and not method.parameter_session_optional:
+                return HTTPStatus.UNAUTHORIZED, b"Invalid session"
+        if trace is not None:
+            mark = perf_counter_ns()
+        if method.cache is not None:
+            tags = format_tags(method.tags, parameters, session)
+            key = method.cache.key(
+                path,
+                parameters,
+                session,
+                tags,
+                await generations(self.memcache, tags),
+            )
+            compute = partial(self.invoke, method, parameters, session, context)
+            try:
+                if encoding is None:
+                    result = await method.cache.fetch(self.memcache, key, compute)
+                else:
+                    (
+                        result,
+                        context.content_encoding,
+                    ) = await method.cache.fetch_compressed(
+                        self.memcache,
+                        key,
+                        compute,
+                        encoding,
+                        partial(self.compress, encoding=encoding),
+                    )
+            except OverloadedError as e:
+                context.retry_after = e.retry_after
+                return HTTPStatus.SERVICE_UNAVAILABLE, b"Method is overloaded"
+            if trace is not None:
+                trace.add("cache", mark)
+            return HTTPStatus.OK, result
+        queued = method.limit is not None or self.scheduler is not None
+        if queued:
+            try:
+                await self.acquire(method, session)
+            except OverloadedError as e:
+                context.retry_after = e.retry_after
+                return HTTPStatus.SERVICE_UNAVAILABLE, b"Method is overloaded"
+            if trace is not None:
+                mark = trace.add("queue", mark)
+        if method.streaming:
+            results = method.invoke(parameters, session, context.credentials, stream)
+            return HTTPStatus.OK, ndjson(
+                hold(results, partial(self.release, method)) if queued else results
+            )
+        try:
+            if method.executor is None:
+                result = await method.invoke(
+                    parameters, session, context.credentials, stream
+                )
+            else:
+                result = await self.executors.run(
+                    method, parameters, session, context.credentials
+                )
+        except BodyTooLargeError:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"Request body is too large"
+        finally:
+            if queued:
+                self.release(method)
+        if trace is not None:
+            mark = trace.add("handler", mark)
+        if method.invalidates:
+            await invalidate(
+                self.memcache, format_tags(method.invalidates, parameters, session)
+            )
+            if trace is not None:
+                mark = trace.add("invalidate", mark)
+        encoded = encoder.encode(result)
+        if trace is not None:
+            trace.add("encode", mark)
+        return HTTPStatus.OK, encoded
+
+    async def invoke(
+        self,
+        method: Method,
+        parameters: msgspec.Struct | None,
+        session: U | None,
+        context: Context[T, U],
+    ) -> bytes:
+        """Call a cached method within its concurrency limit, encode its result."""
+        await self.acquire(method, session)
+        try:
+            if method.executor is not None:
+                result = await self.executors.run(
+                    method, parameters, session, context.credentials
+                )
+            else:
+                result = await method.invoke(
+                    parameters, session, context.credentials, None
+                )
+        finally:
+            self.release(method)
+        return encoder.encode(result)
+
+    async def acquire(self, method: Method, session: U | None) -> None:
+        """Wait for the method's concurrency limit, then for the scheduler.
+
+        Raise OverloadedError if the call is shed by either.
+        """
+        limit = method.limit
+        if limit is not None:
+            await limit.acquire()
+        if self.scheduler is not None:
+            try:
+                await self.scheduler.acquire(method.priority, session)
+            except BaseException:
+                if limit is not None:
+                    limit.release()
+                raise
+
+    def release(self, method: Method) -> None:
+        if self.scheduler is not None:
+            self.scheduler.release()
+        if method.limit is not None:
+            method.limit.release()
+
+    def compress(self, body: bytes, encoding: str) -> bytes | None:
+        """Compress a body if it is large enough to be worth it."""
+        assert self.compression_threshold is not None
+        if len(body) < self.compression_threshold:
+            return None
+        return self.compressor.compress(body, encoding)
+
+    async def batch(
+        self, body: bytes | bytearray, context: Context[T, U]
+    ) -> tuple[HTTPStatus, bytes]:
+        """Run an array of method calls concurrently.
+
+        Every call gets its own status in the response array, a failing call does
+        not fail the others.
+        """
+        try:
+            calls = batch_decoder.decode(body)
+        except (msgspec.DecodeError, msgspec.ValidationError):
+            return HTTPStatus.BAD_REQUEST, b"Invalid batch"
+        if len(calls) > self.max_batch_size:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"Batch is too large"
+        results = await asyncio.gather(
+            *(self.batch_call(call, context) for call in calls)
+        )
+        return HTTPStatus.OK, encoder.encode(results)
+
+    async def batch_call(self, call: BatchCall, context: Context[T, U]) -> BatchResult:
+        status, body = await self.call_multiplexed(
+            f"/{call.method}", call.parameters, context, websocket=False
+        )
+        return BatchResult(status, msgspec.Raw(body))
+
+    async def call_multiplexed(
+        self,
+        path: str,
+        parameters: bytes,
+        context: Context[T, U],
+        *,
+        websocket: bool,
+    ) -> tuple[HTTPStatus, bytes]:
+        """Call a method sharing a request with other calls.
+
+        Failures are returned as a JSON string instead of being raised. Methods which
+        need a request of their own get UPGRADE_REQUIRED, over a WebSocket this
+        includes methods which set credentials since cookies can't be set.
+        """
+        start = perf_counter_ns()
+        method = methods.get(path)
+        if method is not None and (
+            method.streaming
+            or method.body_parameter is not None
+            or (websocket and method.uses_credentials)
+        ):
+            status, body = HTTPStatus.UPGRADE_REQUIRED, b"Method requires HTTP"
+        else:
+            try:
+                status, body = await self.call(path, parameters, context)
+                assert isinstance(body, bytes)
+            except Exception:
+                logger.exception("Method %r raised an exception", path)
+                status, body = (
+                    HTTPStatus.INTERNAL_SERVER_ERROR,
+                    b"Internal server error",
+                )
+        if status != HTTPStatus.OK:
+            body = encoder.encode(body.decode())
+        self.metrics.record(
+            path, status, len(parameters), len(body), perf_counter_ns() - start
+        )
+        return status, body
+
+    def on_disconnect(self, context: Context[T, U], task: asyncio.Task[Any]) -> None:
+        """Cancel the call of a client which disconnected, nobody reads its result.
+
+        Streamed results are not cancelled, sending them fails instead.
+        """
+        context.disconnected = True
+        task.cancel()
+
+    async def on_lifespan(
+        self,
+        scope: LifespanScope,
+        receive: ASGIReceiveCallable,
         send: ASGISendCallable,
     ) -> None:
-        pass
+        while True:
+            event = await receive()
+            match event["type"]:
+                case "lifespan.startup":
+                    await self.on_startup(scope, event, send)
+                case "lifespan.shutdown":
+                    await self.on_shutdown(scope, event, send)
+                    return
+                case _:
+                    pass
+
+    def check_priorities(self) -> None:
+        """Raise ValueError if the scheduler has no weight for a method."""
+        if self.scheduler is None:
+            return
+        for path, method in methods.items():
+            if method.priority not in self.scheduler.weights:
+                msg = (
+                    f"Method {path!r} has priority {method.priority!r} "
+                    "which the scheduler has no weight for"
+                )
+                raise ValueError(msg)
 
     async def on_startup(
         self,
-        scope: Scope,
+        scope: LifespanScope,
         event: LifespanStartupEvent,
         send: ASGISendCallable,
     ) -> None:
-        pass
+        """Warm up and run the startup hooks before the server accepts traffic."""
+        try:
+            self.check_priorities()
+            await self.memcache.connect()
+            # Decoders are built on first use, build the one for sessions now.
+            serde = getattr(self.memcache, "serde", None)
+            if isinstance(serde, MsgpackSerde):
+                serde.decoder(self.sessions.session_type)
+            for hook in self.startup_hooks:
+                await hook()
+        except Exception as e:
+            logger.exception("Startup failed")
+            await send({"type": "lifespan.startup.failed", "message": str(e)})
+            return
+        await send({"type": "lifespan.startup.complete"})
 
     async def on_shutdown(
         self,
-        scope: Scope,
+        scope: LifespanScope,
         event: LifespanShutdownEvent,
         send: ASGISendCallable,
     ) -> None:
-        pass
+        """Stop accepting calls, drain the in-flight ones and close connections.
+
+        Calls still running after `shutdown_timeout` seconds are cancelled.
+        """
+        self.accepting = False
+        try:
+            if self.inflight:
+                _, pending = await asyncio.wait(
+                    self.inflight, timeout=self.shutdown_timeout
+                )
+                if pending:
+                    logger.warning("Cancelling %d calls on shutdown", len(pending))
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.wait(pending)
+            for connection in list(self.websockets):
+                # Service restart, the client should reconnect.
+                await connection.close(1012)
+            for hook in self.shutdown_hooks:
+                await hook()
+            await self.executors.shutdown()
+            await self.memcache.close()
+        except Exception as e:
+            logger.exception("Shutdown failed")
+            await send({"type": "lifespan.shutdown.failed", "message": str(e)})
+            return
+        await send({"type": "lifespan.shutdown.complete"})
+
+    async def on_websocket(
+        self,
+        scope: WebSocketScope,
+        receive: ASGIReceiveCallable,
+        send: ASGISendCallable,
+    ) -> None:
+        connection: WebSocketConnection[T, U] | None = None
+        while True:
+            event = await receive()
+            match event["type"]:
+                case "websocket.connect":
+                    connection = await self.on_websocket_connect(scope, event, send)
+                    if connection is None:
+                        return
+                case "websocket.receive":
+                    assert connection is not None
+                    await self.on_websocket_receive(connection, event)
+                    if connection.closed:
+                        self.websockets.discard(connection)
+                        await connection.cancel()
+                        return
+                case "websocket.disconnect":
+                    if connection is not None:
+                        await self.on_websocket_disconnect(connection, event)
+                    return
+                case _:
+                    pass
 
     async def on_websocket_connect(
         self,
-        scope: Scope,
+        scope: WebSocketScope,
         event: WebSocketConnectEvent,
         send: ASGISendCallable,
-    ) -> None:
-        pass
+    ) -> WebSocketConnection[T, U] | None:
+        if scope["path"] != self.websocket_path:
+            await send({"type": "websocket.close", "code": 1008})
+            return None
+        if not self.accepting:
+            await send({"type": "websocket.close", "code": 1012})
+            return None
+        headers = get_headers(scope)
+        assert scope["client"] is not None
+        context = Context(
+            self.sessions,
+            scope["client"][0],
+            Credentials(headers.get(b"cookie", None)),
+        )
+        context.prefetch_session()
+        await send({"type": "websocket.accept"})
+        connection = WebSocketConnection(context, send, self.max_websocket_calls)
+        self.websockets.add(connection)
+        return connection
 
     async def on_websocket_receive(
         self,
-        scope: Scope,
+        connection: WebSocketConnection[T, U],
         event: WebSocketReceiveEvent,
-        send: ASGISendCallable,
     ) -> None:
-        pass
+        try:
+            call = websocket_decoder.decode(
+                event.get("text") or event.get("bytes") or b""
+            )
+        except (msgspec.DecodeError, msgspec.ValidationError):
+            await connection.close(1007)
+            return
+        if not self.accepting:
+            body = encoder.encode("Server is shutting down")
+            await connection.reply(
+                WebSocketResult(
+                    call.id, HTTPStatus.SERVICE_UNAVAILABLE, msgspec.Raw(body)
+                )
+            )
+            return
+        # Stop reading frames while too many calls are in flight.
+        await connection.slots.acquire()
+        task = asyncio.create_task(self.websocket_call(connection, call))
+        connection.tasks.add(task)
+        task.add_done_callback(connection.tasks.discard)
+        self.track(task)
+
+    async def websocket_call(
+        self, connection: WebSocketConnection[T, U], call: WebSocketCall
+    ) -> None:
+        try:
+            status, body = await self.call_multiplexed(
+                f"/{call.method}", call.parameters, connection.context, websocket=True
+            )
+            await connection.reply(WebSocketResult(call.id, status, msgspec.Raw(body)))
+        finally:
+            connection.slots.release()
 
     async def on_websocket_disconnect(
         self,
-        scope: Scope,
+        connection: WebSocketConnection[T, U],
         event: WebSocketDisconnectEvent,
-        send: ASGISendCallable,
     ) -> None:
-        pass
+        self.websockets.discard(connection)
+        await connection.cancel()
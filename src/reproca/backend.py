@@ -0,0 +1,388 @@
+"""Key-value storage behind sessions, rate limiting and result caching.
+
+`Backend` is the subset of the memcached client reproca relies on, `Memcache`
+implements it over the network and `LocalBackend` in the process, for a single
+worker which can afford to lose its sessions on restart.
+"""
+
+from __future__ import annotations
+
+__all__ = ["Backend", "BackendPipeline", "LocalBackend", "LocalPipeline"]
+
+import heapq
+import itertools
+import sys
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Protocol
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+
+    from .rate_limit import RateLimit
+
+
+class BackendPipeline(Protocol):
+    """Commands queued to be executed in one round trip.
+
+    Commands with noreply=True don't produce a result, execute() returns the
+    results of the remaining commands in order.
+    """
+
+    def set(
+        self, key: str, value: Any, expire: int = 0, noreply: bool = False
+    ) -> None: ...
+
+    def add(
+        self, key: str, value: Any, expire: int = 0, noreply: bool = False
+    ) -> None: ...
+
+    def cas(
+        self, key: str, value: Any, cas: int, expire: int = 0, noreply: bool = False
+    ) -> None: ...
+
+    def get(self, key: str, default: Any = None, as_type: Any = Any) -> None: ...
+
+    def gets(self, key: str, default: Any = None, as_type: Any = Any) -> None: ...
+
+    def delete(self, key: str, noreply: bool = False) -> None: ...
+
+    def incr(self, key: str, value: int, noreply: bool = False) -> None: ...
+
+    def decr(self, key: str, value: int, noreply: bool = False) -> None: ...
+
+    def touch(self, key: str, expire: int, noreply: bool = False) -> None: ...
+
+    async def execute(self) -> list[Any]: ...
+
+
+class Backend(Protocol):
+    """Storage with memcached semantics.
+
+    Expiration times are in seconds from now, 0 never expires and a negative
+    one expires at once. Counters are unsigned: decrementing below 0 gives 0.
+    Every modification of a key changes its CAS token.
+    """
+
+    async def connect(self) -> None: ...
+
+    async def close(self) -> None: ...
+
+    async def get(self, key: str, default: Any = None, as_type: Any = Any) -> Any: ...
+
+    async def gets(
+        self, key: str, default: Any = None, as_type: Any = Any
+    ) -> tuple[Any, int | None]: ...
+
+    async def get_many(
+        self, keys: Iterable[str], as_type: Any = Any
+    ) -> dict[str, Any]: ...
+
+    async def set(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool: ...
+
+    async def add(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool: ...
+
+    async def replace(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool: ...
+
+    async def cas(
+        self, key: str, value: Any, cas: int, expire: int = 0, noreply: bool = False
+    ) -> bool: ...
+
+    async def incr(self, key: str, value: int, noreply: bool = False) -> int | None: ...
+
+    async def decr(self, key: str, value: int, noreply: bool = False) -> int | None: ...
+
+    async def delete(self, key: str, noreply: bool | None = None) -> bool: ...
+
+    async def delete_many(
+        self, keys: Iterable[str], noreply: bool | None = None
+    ) -> bool: ...
+
+    async def touch(
+        self, key: str, expire: int, noreply: bool | None = None
+    ) -> bool: ...
+
+    def pipeline(self) -> BackendPipeline: ...
+
+    async def rate_limit(
+        self, accessor: str, resource: str, limit: RateLimit
+    ) -> bool: ...
+
+
+type Entry = tuple[Any, float, int, int]
+
+# Rough per-entry cost of the dict slot, the entry tuple and the heap item.
+ENTRY_OVERHEAD = 200
+NEVER = float("inf")
+
+
+class LocalBackend:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024) -> None:
+        """Initialize an in-process backend.
+
+        Entries live in a dict, their expiration times in a heap. Expired
+        entries are dropped when read and, through the heap, on every write, so
+        expiring costs nothing on the read path. Beyond `max_bytes` the least
+        recently used entries are evicted, like memcached does.
+
+        Values are stored as is, not serialized: they must not be mutated after
+        being stored or retrieved.
+
+        Args:
+        ----
+            max_bytes: The memory cap. Sizes are estimated with sys.getsizeof,
+                which doesn't follow references, so nested values are
+                undercounted.
+
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        # Keys map to (value, deadline, size, CAS token) tuples.
+        self.entries: OrderedDict[str, Entry] = OrderedDict()
+        self.deadlines: list[tuple[float, str]] = []
+        self.tokens = itertools.count(1)
+
+    async def connect(self) -> None:
+        """Nothing to connect to."""
+
+    async def close(self) -> None:
+        """Nothing to close, entries are kept."""
+
+    def lookup(self, key: str) -> Entry | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def remove(self, key: str) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[2]
+        return True
+
+    def expire(self) -> None:
+        """Drop the entries whose deadline passed, oldest first."""
+        deadlines = self.deadlines
+        now = time.monotonic()
+        while deadlines and deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(deadlines)
+            entry = self.entries.get(key)
+            # The entry may have been stored again or touched since.
+            if entry is not None and entry[1] == deadline:
+                self.remove(key)
+        if len(deadlines) > 2 * len(self.entries) + 64:
+            # Rewritten keys leave stale items behind, drop them.
+            self.deadlines = [
+                (entry[1], key)
+                for key, entry in self.entries.items()
+                if entry[1] != NEVER
+            ]
+            heapq.heapify(self.deadlines)
+
+    def put(
+        self,
+        key: str,
+        value: Any,
+        expire: int,
+        size: int | None = None,
+        token: int | None = None,
+    ) -> None:
+        self.expire()
+        self.remove(key)
+        if expire < 0:
+            return
+        if size is None:
+            size = sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+        deadline = NEVER
+        if expire:
+            deadline = time.monotonic() + expire
+            heapq.heappush(self.deadlines, (deadline, key))
+        if token is None:
+            token = next(self.tokens)
+        self.entries[key] = (value, deadline, size, token)
+        self.size += size
+        while self.size > self.max_bytes and self.entries:
+            _, (_, _, evicted, _) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def store(self, name: str, key: str, value: Any, expire: int) -> bool:
+        if name != "set" and (self.lookup(key) is None) != (name == "add"):
+            return False
+        self.put(key, value, expire)
+        return True
+
+    def check_and_set(self, key: str, value: Any, cas: int, expire: int) -> bool:
+        entry = self.lookup(key)
+        if entry is None or entry[3] != cas:
+            return False
+        self.put(key, value, expire)
+        return True
+
+    def counter(self, key: str, value: int) -> int | None:
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        current, deadline, size, _ = entry
+        if not isinstance(current, int):
+            msg = f"Cannot increment or decrement non-numeric value of {key!r}"
+            raise TypeError(msg)
+        current = max(0, current + value)
+        self.entries[key] = (current, deadline, size, next(self.tokens))
+        return current
+
+    def retouch(self, key: str, expire: int) -> bool:
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+        self.put(key, entry[0], expire, entry[2], entry[3])
+        return True
+
+    def get_value(self, key: str, default: Any = None) -> Any:
+        entry = self.lookup(key)
+        return default if entry is None else entry[0]
+
+    async def get(self, key: str, default: Any = None, as_type: Any = Any) -> Any:
+        """Get the value of a key, return default if not found."""
+        return self.get_value(key, default)
+
+    def get_token(self, key: str, default: Any = None) -> tuple[Any, int | None]:
+        entry = self.lookup(key)
+        return (default, None) if entry is None else (entry[0], entry[3])
+
+    async def gets(
+        self, key: str, default: Any = None, as_type: Any = Any
+    ) -> tuple[Any, int | None]:
+        """Get the value of a key and its CAS token, (default, None) if not found."""
+        return self.get_token(key, default)
+
+    async def get_many(self, keys: Iterable[str], as_type: Any = Any) -> dict[str, Any]:
+        """Get the values of several keys, missing keys are omitted."""
+        return {
+            key: entry[0] for key in keys if (entry := self.lookup(key)) is not None
+        }
+
+    async def set(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool:
+        """Store a value."""
+        return self.store("set", key, value, expire)
+
+    async def add(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool:
+        """Store a value only if the key does not exist."""
+        return self.store("add", key, value, expire)
+
+    async def replace(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool:
+        """Store a value only if the key already exists."""
+        return self.store("replace", key, value, expire)
+
+    async def cas(
+        self, key: str, value: Any, cas: int, expire: int = 0, noreply: bool = False
+    ) -> bool:
+        """Store a value only if its CAS token is still `cas`, return True if stored."""
+        return self.check_and_set(key, value, cas, expire)
+
+    async def incr(self, key: str, value: int, noreply: bool = False) -> int | None:
+        """Increment a counter, return the new value or None if not found."""
+        return self.counter(key, value)
+
+    async def decr(self, key: str, value: int, noreply: bool = False) -> int | None:
+        """Decrement a counter, return the new value or None if not found."""
+        return self.counter(key, -value)
+
+    async def delete(self, key: str, noreply: bool | None = None) -> bool:
+        """Delete a key, return True if it existed."""
+        return self.remove(key)
+
+    async def delete_many(
+        self, keys: Iterable[str], noreply: bool | None = None
+    ) -> bool:
+        """Delete several keys."""
+        for key in keys:
+            self.remove(key)
+        return True
+
+    async def touch(self, key: str, expire: int, noreply: bool | None = None) -> bool:
+        """Update the expiration time of a key, return True if it existed."""
+        return self.retouch(key, expire)
+
+    def pipeline(self) -> LocalPipeline:
+        """Batch several commands, for compatibility with memcached."""
+        return LocalPipeline(self)
+
+    async def rate_limit(self, accessor: str, resource: str, limit: RateLimit) -> bool:
+        """Rate limit an accessor for a resource.
+
+        Returns True if the accessor is NOT allowed to access the resource.
+        """
+        return await limit.exceeded(self, f"accessor={accessor};resource={resource}")
+
+
+class LocalPipeline:
+    """Commands queued to be executed together on a LocalBackend.
+
+    Nothing can interleave with them since they run without yielding to the
+    event loop, as a pipeline on a single memcached connection.
+    """
+
+    def __init__(self, backend: LocalBackend) -> None:
+        self.backend = backend
+        self.commands: list[tuple[Callable[[], Any], bool]] = []
+
+    def set(self, key: str, value: Any, expire: int = 0, noreply: bool = False) -> None:
+        self.commands.append(
+            (lambda: self.backend.store("set", key, value, expire), noreply)
+        )
+
+    def add(self, key: str, value: Any, expire: int = 0, noreply: bool = False) -> None:
+        self.commands.append(
+            (lambda: self.backend.store("add", key, value, expire), noreply)
+        )
+
+    def cas(
+        self, key: str, value: Any, cas: int, expire: int = 0, noreply: bool = False
+    ) -> None:
+        self.commands.append(
+            (lambda: self.backend.check_and_set(key, value, cas, expire), noreply)
+        )
+
+    def get(self, key: str, default: Any = None, as_type: Any = Any) -> None:
+        self.commands.append((lambda: self.backend.get_value(key, default), False))
+
+    def gets(self, key: str, default: Any = None, as_type: Any = Any) -> None:
+        self.commands.append((lambda: self.backend.get_token(key, default), False))
+
+    def delete(self, key: str, noreply: bool = False) -> None:
+        self.commands.append((lambda: self.backend.remove(key), noreply))
+
+    def incr(self, key: str, value: int, noreply: bool = False) -> None:
+        self.commands.append((lambda: self.backend.counter(key, value), noreply))
+
+    def decr(self, key: str, value: int, noreply: bool = False) -> None:
+        self.commands.append((lambda: self.backend.counter(key, -value), noreply))
+
+    def touch(self, key: str, expire: int, noreply: bool = False) -> None:
+        self.commands.append((lambda: self.backend.retouch(key, expire), noreply))
+
+    async def execute(self) -> list[Any]:
+        commands, self.commands = self.commands, []
+        results: list[Any] = []
+        for command, noreply in commands:
+            result = command()
+            if not noreply:
+                results.append(result)
+        return results
@@ -0,0 +1,60 @@
+"""The reproca command line.
+
+Usage: reproca codegen MODULE --output FILE [--prelude FILE]
+"""
+
+from __future__ import annotations
+
+__all__ = ["main"]
+
+import argparse
+import importlib
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .code_generation import generate, write_if_changed
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+DEFAULT_PRELUDE = """\
+import {App, type MethodResult} from "reproca/app"
+const app = new App(import.meta.env.VITE_API)
+"""
+
+
+def codegen(module: str, output: Path, prelude: Path | None) -> bool:
+    """Generate the TypeScript client of the methods registered by a module.
+
+    Return whether the output was written, it is left alone if up to date.
+    """
+    # Import the application like a server started from here would.
+    sys.path.insert(0, str(Path.cwd()))
+    importlib.import_module(module)
+    source = generate(DEFAULT_PRELUDE if prelude is None else prelude.read_text())
+    return write_if_changed(output, source)
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="reproca")
+    commands = parser.add_subparsers(dest="command", required=True)
+    parser_codegen = commands.add_parser(
+        "codegen", help="generate the TypeScript client of the methods"
+    )
+    parser_codegen.add_argument(
+        "module", help="the module registering the methods, e.g. src.backend"
+    )
+    parser_codegen.add_argument(
+        "--output", type=Path, required=True, help="the TypeScript file to write"
+    )
+    parser_codegen.add_argument(
+        "--prelude",
+        type=Path,
+        help="TypeScript code defining `app` and importing `MethodResult`",
+    )
+    args = parser.parse_args(argv)
+    if codegen(args.module, args.output, args.prelude):
+        print(f"Wrote {args.output}")  # noqa: T201
+    else:
+        print(f"{args.output} is up to date")  # noqa: T201
@@ -1,10 +1,14 @@
 from enum import Enum
 from platform import python_version_tuple
 
-__all__ = ["CodeGenerator"]
+__all__ = ["CodeGenerator", "generate", "write_if_changed"]
 
 import functools
+import hashlib
+import io
+import os
 import sys
+import tempfile
 import typing
 from collections.abc import (
     Callable,
@@ -17,6 +21,7 @@ from collections.abc import (
     Sequence,
 )
 from datetime import datetime
+from pathlib import Path
 from types import NoneType, UnionType, get_original_bases
 from typing import (
     IO,
@@ -33,7 +38,7 @@ from typing import (
 
 import msgspec
 
-from .method import SPECIAL_PARAMETERS, Method
+from .method import Method, methods
 
 
 def get_type_alias_value(obj: TypeAliasType) -> object:
@@ -66,7 +71,9 @@ class Writer:
 class CodeGenerator(Writer):
     def __init__(self, file: IO[str]) -> None:
         super().__init__(file)
-        self.unresolved: set[type[Enum | msgspec.Struct] | TypeAliasType] = set()
+        # Ordered like a set of the types to declare, so that the output doesn't
+        # change from run to run with the hashes of the types.
+        self.unresolved: dict[type[Enum | msgspec.Struct] | TypeAliasType, None] = {}
         self.resolved: set[object] = set()
 
     def resolve(self) -> None:
@@ -74,7 +81,7 @@ class CodeGenerator(Writer):
             return
         self.resolved.update(self.unresolved)
         unresolved = self.unresolved
-        self.unresolved = set()
+        self.unresolved = {}
         for obj in unresolved:
             if isinstance(obj, TypeAliasType):
                 self.type_alias(obj)
@@ -127,7 +134,7 @@ class CodeGenerator(Writer):
         match type_object:
             case type() if issubclass(type_object, Enum):
                 if type_object not in self.resolved:
-                    self.unresolved.add(type_object)
+                    self.unresolved[type_object] = None
                 self.write(type_object.__name__)
             case msgspec.UnsetType():
                 self.write("undefined")
@@ -143,7 +150,7 @@ class CodeGenerator(Writer):
                 self.write("string")
             case type() if issubclass(type_object, msgspec.Struct):
                 if type_object not in self.resolved:
-                    self.unresolved.add(type_object)
+                    self.unresolved[type_object] = None
                 self.write(type_object.__name__)
             case type() if type_object is msgspec.UnsetType:
                 self.write("undefined")
@@ -151,7 +158,7 @@ class CodeGenerator(Writer):
                 self.write(type_object.__name__)
             case TypeAliasType():
                 if type_object not in self.resolved:
-                    self.unresolved.add(type_object)
+                    self.unresolved[type_object] = None
                 self.write(type_object.__name__)
             case type() if type_object is Any:
                 self.write("any")
@@ -164,7 +171,7 @@ class CodeGenerator(Writer):
             case TypeAliasType():
                 args = get_args(type_object)
                 if orig not in self.resolved:
-                    self.unresolved.add(orig)
+                    self.unresolved[orig] = None
                 self.write(orig.__name__)
                 self.write("<")
                 self.intersperse(
@@ -175,7 +182,7 @@ class CodeGenerator(Writer):
             case type() if issubclass(orig, msgspec.Struct):
                 args = get_args(type_object)
                 if orig not in self.resolved:
-                    self.unresolved.add(orig)
+                    self.unresolved[orig] = None
                 self.write(orig.__name__)
                 self.write("<")
                 self.intersperse(
@@ -280,21 +287,80 @@ class CodeGenerator(Writer):
 
     def method(self, method: Method) -> None:
         self.doc(method.implementation.__doc__)
-        self.write(
-            "export async function ", method.implementation.__name__, "(parameters: "
-        )
+        name = method.implementation.__name__
+        self.write("export ", "function " if method.streaming else "async function ")
+        self.write(name, "(")
+        if method.body_parameter is not None:
+            self.write("body: BodyInit, ")
+        self.write("parameters: ")
         self.type_object(method.type)
-        if (
-            len([key for key in method.type_hints if key not in SPECIAL_PARAMETERS])
-            == 0
-        ):
+        if not method.type.__struct_fields__:
             self.write(" = {}")
+        if method.streaming:
+            self.write("):AsyncIterable<")
+            self.type_object(get_args(method.type_hints["return"])[0])
+            self.write(">{return app.stream(", repr(name), ", parameters);}\n")
+            return
         self.write("):Promise<MethodResult<")
         self.type_object(method.type_hints["return"])
         self.write(">>{")
-        self.write(
-            "return await app.method(",
-            repr(method.implementation.__name__),
-            ", parameters);",
-        )
+        if method.body_parameter is not None:
+            self.write("return await app.upload(", repr(name), ", body, parameters);")
+        else:
+            self.write("return await app.method(", repr(name), ", parameters);")
         self.write("}\n")
+
+
+FINGERPRINT_PREFIX = "// reproca fingerprint: "
+
+
+def generate(prelude: str = "") -> str:
+    """Generate the TypeScript client of all the registered methods.
+
+    The prelude must define the `app` the generated functions call, and import
+    `MethodResult`.
+    """
+    file = io.StringIO()
+    code_generator = CodeGenerator(file)
+    code_generator.write(prelude)
+    for method in methods.values():
+        code_generator.method(method)
+    code_generator.resolve()
+    return file.getvalue()
+
+
+def read_fingerprint(path: Path) -> str | None:
+    try:
+        with path.open() as file:
+            line = file.readline()
+    except FileNotFoundError:
+        return None
+    if not line.startswith(FINGERPRINT_PREFIX):
+        return None
+    return line.removeprefix(FINGERPRINT_PREFIX).strip()
+
+
+def write_if_changed(path: str | os.PathLike[str], source: str) -> bool:
+    """Write generated code unless the file already holds the same code.
+
+    The file starts with a fingerprint of the code, which survives reformatting
+    the rest of it, and is replaced atomically: an unchanged client doesn't
+    trigger rebuilds, and processes generating it concurrently don't race.
+    Return whether the file was written.
+    """
+    path = Path(path)
+    fingerprint = hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+    if read_fingerprint(path) == fingerprint:
+        return False
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as file:
+        file.write(f"{FINGERPRINT_PREFIX}{fingerprint}\n{source}")
+    try:
+        # NamedTemporaryFile creates files readable by the owner only.
+        Path(file.name).chmod(0o644)
+        Path(file.name).replace(path)
+    except BaseException:
+        Path(file.name).unlink(missing_ok=True)
+        raise
+    return True
@@ -0,0 +1,62 @@
+"""Negotiated compression of response bodies."""
+
+from __future__ import annotations
+
+__all__ = ["Compressor", "negotiate"]
+
+import zlib
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+# zlib window bits producing each Content-Encoding, in order of preference.
+WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+
+@lru_cache(maxsize=256)
+def negotiate(accept_encoding: bytes | None) -> str | None:
+    """Pick the preferred encoding the client accepts, None for identity.
+
+    Clients send few distinct headers, so the choices are memoized.
+    """
+    if not accept_encoding:
+        return None
+    qualities: dict[str, float] = {}
+    for item in accept_encoding.decode("latin-1").split(","):
+        name, _, parameters = item.partition(";")
+        quality = 1.0
+        parameter = parameters.strip()
+        if parameter.startswith("q="):
+            try:
+                quality = float(parameter[2:])
+            except ValueError:
+                continue
+        qualities[name.strip().lower()] = quality
+    wildcard = qualities.get("*", 0.0)
+    best = max(WBITS, key=lambda encoding: qualities.get(encoding, wildcard))
+    return best if qualities.get(best, wildcard) > 0 else None
+
+
+class Compressor:
+    """Compress bodies with zlib at a fixed level."""
+
+    def __init__(self, level: int = 6) -> None:
+        self.level = level
+
+    def compress(self, data: bytes, encoding: str) -> bytes:
+        return zlib.compress(data, self.level, WBITS[encoding])
+
+    async def stream(
+        self, chunks: AsyncIterator[bytes], encoding: str
+    ) -> AsyncIterator[bytes]:
+        """Compress a streamed body, flushing after every chunk.
+
+        A chunk reaches the client as soon as it is produced, as without
+        compression, at the cost of a few bytes per flush.
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+        async for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
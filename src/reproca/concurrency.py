@@ -0,0 +1,235 @@
+"""Per-method concurrency limits which shed load instead of queueing forever."""
+
+from __future__ import annotations
+
+__all__ = ["ConcurrencyLimit", "OverloadedError", "Scheduler"]
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import (
+        AsyncGenerator,
+        AsyncIterator,
+        Callable,
+        Hashable,
+        Mapping,
+    )
+
+
+class OverloadedError(Exception):
+    """Raised when a call is rejected to shed load, it should be retried later."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"Overloaded, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimit:
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int = 0,
+        *,
+        target_delay: float | None = None,
+        interval: float = 0.1,
+        retry_after: int = 1,
+    ) -> None:
+        """Initialize a limit on the concurrent calls of a method.
+
+        Calls beyond `max_concurrency` wait in a FIFO queue of `max_queue` calls,
+        calls beyond that are rejected at once.
+
+        With a `target_delay`, the limit also sheds load adaptively, like CoDel:
+        once calls have waited in the queue longer than `target_delay` for
+        `interval` seconds, calls which would have to wait are rejected until
+        the queueing delay falls below the target again. A slow dependency then
+        costs a short queue instead of a growing backlog.
+
+        Args:
+        ----
+            max_concurrency: The maximum number of calls running at once.
+            max_queue: The maximum number of calls waiting to run.
+            target_delay: The acceptable queueing delay in seconds, None
+                disables adaptive shedding.
+            interval: How long the delay must stay above the target before
+                shedding starts, in seconds.
+            retry_after: The Retry-After of rejected calls, in seconds.
+
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.target_delay = target_delay
+        self.interval = interval
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiters: deque[asyncio.Future[None]] = deque()
+        # Since when admitted calls waited longer than the target, if they do.
+        self.above_since: float | None = None
+        self.shedding = False
+
+    def observe(self, delay: float) -> None:
+        """Update the shedding state from the queueing delay of a call."""
+        if self.target_delay is None:
+            return
+        if delay < self.target_delay:
+            self.above_since = None
+            self.shedding = False
+            return
+        now = time.monotonic()
+        if self.above_since is None:
+            self.above_since = now
+        elif now - self.above_since >= self.interval:
+            self.shedding = True
+
+    async def acquire(self) -> None:
+        """Wait for a slot, raise OverloadedError if the call is shed."""
+        if self.running < self.max_concurrency and not self.waiters:
+            self.running += 1
+            self.observe(0.0)
+            return
+        if len(self.waiters) >= self.max_queue or self.shedding:
+            raise OverloadedError(self.retry_after)
+        future = asyncio.get_running_loop().create_future()
+        enqueued = time.monotonic()
+        self.waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                with contextlib.suppress(ValueError):
+                    self.waiters.remove(future)
+            else:
+                # The slot was handed over just before the cancellation.
+                self.release()
+            raise
+        self.observe(time.monotonic() - enqueued)
+
+    def release(self) -> None:
+        """Hand the slot over to the next waiting call or free it."""
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+
+async def hold[T](
+    iterator: AsyncIterator[T], release: Callable[[], None]
+) -> AsyncGenerator[T, None]:
+    """Keep slots acquired for a streamed result until it is exhausted."""
+    try:
+        async for item in iterator:
+            yield item
+    finally:
+        release()
+
+
+DEFAULT_WEIGHTS = {"interactive": 8.0, "default": 4.0, "bulk": 1.0}
+
+
+class Scheduler:
+    def __init__(
+        self,
+        max_concurrency: int,
+        weights: Mapping[str, float] = DEFAULT_WEIGHTS,
+        max_queue: int | None = None,
+        user_key: Callable[[Any], Hashable] | None = None,
+        retry_after: int = 1,
+    ) -> None:
+        """Initialize a scheduler admitting the calls of a worker by priority.
+
+        At most `max_concurrency` calls run at once. Waiting calls are admitted
+        by weighted fair queuing: every priority class is a flow which gets a
+        share of the admissions proportional to its weight while it has calls
+        waiting, so bulk calls can't starve interactive ones and still progress
+        when interactive calls keep coming.
+
+        Usage:
+        >>> app = App(sessions, memcache, scheduler=Scheduler(64))
+        >>> @method(priority="bulk")
+        ... async def export_todos() -> list[Todo]: ...
+
+        Args:
+        ----
+            max_concurrency: The maximum number of calls running at once.
+            weights: The weight of every priority class.
+            max_queue: The maximum number of waiting calls, further calls are
+                rejected with a 503. Unlimited if None.
+            user_key: Return a hashable key from the session user, to make each
+                user of a class a flow of its own: a user flooding a method
+                then only delays their own calls.
+            retry_after: The Retry-After of rejected calls, in seconds.
+
+        """
+        self.max_concurrency = max_concurrency
+        self.weights = weights
+        self.max_queue = max_queue
+        self.user_key = user_key
+        self.retry_after = retry_after
+        self.running = 0
+        # Waiting calls by finish tag, ties broken by arrival.
+        self.waiters: list[tuple[float, int, asyncio.Future[None]]] = []
+        self.arrivals = itertools.count()
+        # The tag of the last admitted call and the last tag of every flow.
+        self.virtual_time = 0.0
+        self.finish: dict[Hashable, float] = {}
+
+    def flow(self, priority: str, session: Any) -> Hashable:
+        if self.user_key is None or session is None:
+            return priority
+        return (priority, self.user_key(session))
+
+    async def acquire(self, priority: str, session: Any = None) -> None:
+        """Wait until the call is admitted, raise OverloadedError if shed."""
+        if self.running < self.max_concurrency and not self.waiters:
+            self.running += 1
+            return
+        if self.max_queue is not None and len(self.waiters) >= self.max_queue:
+            raise OverloadedError(self.retry_after)
+        flow = self.flow(priority, session)
+        # Every call costs the same, a flow's calls are spaced by 1 / weight.
+        tag = max(self.virtual_time, self.finish.get(flow, 0.0))
+        tag += 1 / self.weights[priority]
+        self.finish[flow] = tag
+        future = asyncio.get_running_loop().create_future()
+        waiter = (tag, next(self.arrivals), future)
+        heapq.heappush(self.waiters, waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # Don't count the call toward max_queue nor the queue depth.
+                with contextlib.suppress(ValueError):
+                    self.waiters.remove(waiter)
+                    heapq.heapify(self.waiters)
+            else:
+                # The slot was handed over just before the cancellation.
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """Admit the waiting call with the smallest finish tag or free the slot."""
+        while self.waiters:
+            tag, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.virtual_time = tag
+                future.set_result(None)
+                self.forget()
+                return
+        self.running -= 1
+
+    def forget(self) -> None:
+        """Drop the tags of idle flows, which restart from the virtual time."""
+        if len(self.finish) > 2 * len(self.waiters) + 64:
+            self.finish = {
+                flow: tag
+                for flow, tag in self.finish.items()
+                if tag > self.virtual_time
+            }
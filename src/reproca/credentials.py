@@ -1,5 +1,6 @@
 from datetime import datetime
 from email.utils import format_datetime
+from functools import cached_property
 from http import cookies as http_cookies
 from typing import Literal
 
@@ -32,12 +33,16 @@ def cookie_parser(cookie_string: str) -> dict[str, str]:
 
 class Credentials:
     def __init__(self, cookie_string: bytes | None) -> None:
-        if cookie_string is not None:
-            self.credentials = cookie_parser(cookie_string.decode("latin-1"))
-        else:
-            self.credentials = {}
+        self.cookie_string = cookie_string
         self._headers = []
 
+    @cached_property
+    def credentials(self) -> dict[str, str]:
+        """The request's cookies, parsed only when a method needs them."""
+        if self.cookie_string is None:
+            return {}
+        return cookie_parser(self.cookie_string.decode("latin-1"))
+
     def set_session(self, sessionid: str | None) -> None:
         self.set_credential("sessionid", sessionid)
 
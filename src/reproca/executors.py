@@ -0,0 +1,140 @@
+"""Pools running blocking or CPU-bound methods off the event loop.
+
+Methods registered with `executor="thread"` run in a thread pool. Methods
+registered with `executor="process"` run in a process pool: their parameters
+and session cross the process boundary encoded with msgpack using the method's
+parameters struct, and the result comes back already encoded as JSON.
+"""
+
+from __future__ import annotations
+
+__all__ = ["Executors"]
+
+import asyncio
+import importlib
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Any
+
+import msgspec
+
+from .method import methods
+
+if TYPE_CHECKING:
+    from multiprocessing.context import BaseContext
+
+    from .credentials import Credentials
+    from .method import ExecutorKind, Method
+
+encoder = msgspec.json.Encoder()
+arguments_encoder = msgspec.msgpack.Encoder()
+# Decoders of the arguments of every method, built in the pool processes.
+arguments_decoders: dict[str, msgspec.msgpack.Decoder[Any]] = {}
+
+
+def arguments_decoder(method: Method) -> msgspec.msgpack.Decoder[Any]:
+    session = method.type_hints.get("session", None)
+    return msgspec.msgpack.Decoder(tuple[method.type | None, session])
+
+
+def run_in_process(module: str, path: str, arguments: bytes) -> bytes:
+    """Call a method in a pool process, return its result encoded as JSON."""
+    # Register the method if the process was spawned rather than forked.
+    importlib.import_module(module)
+    method = methods[path]
+    decoder = arguments_decoders.get(path)
+    if decoder is None:
+        decoder = arguments_decoders[path] = arguments_decoder(method)
+    parameters, session = decoder.decode(arguments)
+    return encoder.encode(method.invoke(parameters, session, None, None))
+
+
+class Executors:
+    def __init__(
+        self,
+        threads: int | None = None,
+        processes: int | None = None,
+        mp_context: BaseContext | None = None,
+    ) -> None:
+        """Initialize the pools of methods which don't run on the event loop.
+
+        The pools are started when a method first needs them.
+
+        Args:
+        ----
+            threads: The size of the thread pool, defaults to that of
+                ThreadPoolExecutor.
+            processes: The size of the process pool, the number of CPUs by
+                default.
+            mp_context: The multiprocessing context starting pool processes.
+                With "spawn" or "forkserver", methods must be defined in an
+                importable module, not in __main__.
+
+        """
+        self.sizes: dict[ExecutorKind, int] = {
+            "thread": threads or min(32, (os.cpu_count() or 1) + 4),
+            "process": processes or os.cpu_count() or 1,
+        }
+        self.mp_context = mp_context
+        self.pools: dict[ExecutorKind, Executor] = {}
+        # Calls submitted and not completed yet.
+        self.pending: dict[ExecutorKind, int] = {"thread": 0, "process": 0}
+
+    def queue_depth(self, kind: ExecutorKind) -> int:
+        """Return the number of calls waiting for a free worker of a pool."""
+        return max(0, self.pending[kind] - self.sizes[kind])
+
+    def pool(self, kind: ExecutorKind) -> Executor:
+        pool = self.pools.get(kind)
+        if pool is None:
+            if kind == "thread":
+                pool = ThreadPoolExecutor(
+                    self.sizes[kind], thread_name_prefix="reproca"
+                )
+            else:
+                pool = ProcessPoolExecutor(self.sizes[kind], mp_context=self.mp_context)
+            self.pools[kind] = pool
+        return pool
+
+    async def run(
+        self,
+        method: Method,
+        parameters: msgspec.Struct | None,
+        session: Any,
+        credentials: Credentials,
+    ) -> Any:
+        """Call a method in its pool.
+
+        The result of a method run in a process is returned as msgspec.Raw
+        JSON, which the encoders copy as is.
+        """
+        assert method.executor is not None
+        kind = method.executor
+        if kind == "thread":
+            call = partial(method.invoke, parameters, session, credentials, None)
+        else:
+            call = partial(
+                run_in_process,
+                method.implementation.__module__,
+                f"/{method.implementation.__name__}",
+                arguments_encoder.encode((parameters, session)),
+            )
+        self.pending[kind] += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.pool(kind), call
+            )
+        finally:
+            self.pending[kind] -= 1
+        return result if kind == "thread" else msgspec.Raw(result)
+
+    async def shutdown(self) -> None:
+        """Stop the pools, after the calls already submitted complete.
+
+        The pools are joined in a thread, the event loop keeps running meanwhile.
+        """
+        pools = list(self.pools.values())
+        self.pools.clear()
+        for pool in pools:
+            await asyncio.to_thread(pool.shutdown)
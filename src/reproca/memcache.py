@@ -1,12 +1,474 @@
-from pymemcache import serde
-from pymemcache.client.base import Client
+"""Asyncio memcached client for reproca applications."""
 
+from __future__ import annotations
 
-class Memcache(Client):
-    def __init__(self, address: tuple[str, int] | str) -> None:
-        super().__init__(address, serde=serde.pickle_serde)
+__all__ = ["Memcache", "MemcacheError", "Pipeline"]
 
-    def rate_limit(self, accessor: str, resource: str, rate: int) -> bool:
+import asyncio
+from collections import deque
+from collections.abc import Awaitable, Callable, Collection, Iterable
+from functools import partial
+from typing import TYPE_CHECKING, Any
+
+from pymemcache.client.base import normalize_server_spec
+
+from .serde import MsgpackSerde
+
+if TYPE_CHECKING:
+    from .rate_limit import RateLimit
+    from .serde import Serde
+
+type Parser = Callable[[asyncio.StreamReader], Awaitable[Any]]
+
+
+class MemcacheError(Exception):
+    """Raised when memcached replies with an error."""
+
+
+class _ServerError(MemcacheError):
+    """A SERVER_ERROR reply, the connection is still usable after it."""
+
+
+MAX_KEY_LENGTH = 250
+
+
+def encode_key(key: str) -> bytes:
+    encoded = key.encode()
+    if len(encoded) > MAX_KEY_LENGTH or any(
+        byte <= ord(" ") or byte == ord("\x7f") for byte in encoded
+    ):
+        msg = f"Invalid memcache key: {key!r}"
+        raise ValueError(msg)
+    return encoded
+
+
+async def read_line(reader: asyncio.StreamReader) -> bytes:
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        msg = "Connection closed by memcached"
+        raise MemcacheError(msg)
+    line = line[:-2]
+    if line.startswith(b"SERVER_ERROR"):
+        raise _ServerError(line.decode(errors="replace"))
+    if line.startswith((b"ERROR", b"CLIENT_ERROR")):
+        raise MemcacheError(line.decode(errors="replace"))
+    return line
+
+
+async def read_values(
+    reader: asyncio.StreamReader, keys: Collection[bytes]
+) -> dict[bytes, tuple[bytes, int, int]]:
+    """Read the reply of a retrieval of `keys` as {key: (value, flags, cas)}.
+
+    A value of a key which was not requested means replies are out of sync with
+    requests: MemcacheError is raised, which drops the connection, rather than
+    returning the value of another key.
+    """
+    values: dict[bytes, tuple[bytes, int, int]] = {}
+    while (line := await read_line(reader)) != b"END":
+        _, key, flags, length, *cas = line.split()
+        if key not in keys:
+            msg = f"Reply for key {key!r} which was not requested, out of sync"
+            raise MemcacheError(msg)
+        data = await reader.readexactly(int(length) + 2)
+        values[key] = (data[:-2], int(flags), int(cas[0]) if cas else 0)
+    return values
+
+
+async def read_stored(reader: asyncio.StreamReader) -> bool:
+    return await read_line(reader) == b"STORED"
+
+
+async def read_deleted(reader: asyncio.StreamReader) -> bool:
+    return await read_line(reader) == b"DELETED"
+
+
+async def read_touched(reader: asyncio.StreamReader) -> bool:
+    return await read_line(reader) == b"TOUCHED"
+
+
+async def read_number(reader: asyncio.StreamReader) -> int | None:
+    line = await read_line(reader)
+    if line == b"NOT_FOUND":
+        return None
+    return int(line)
+
+
+def read_all(*parsers: Parser) -> Parser:
+    """Combine the parsers of pipelined commands into one parser.
+
+    Every reply is consumed even if one of them is a SERVER_ERROR, so that the
+    connection stays in sync; the first error is raised afterwards.
+    """
+
+    async def parse(reader: asyncio.StreamReader) -> list[Any]:
+        results: list[Any] = []
+        error: _ServerError | None = None
+        for parser in parsers:
+            try:
+                results.append(await parser(reader))
+            except _ServerError as e:
+                error = error or e
+                results.append(None)
+        if error is not None:
+            raise error
+        return results
+
+    return parse
+
+
+class Connection:
+    """A single memcached connection which pipelines requests.
+
+    Requests are written as soon as they are made, replies are read in order by a
+    background task and handed to the waiting callers.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        on_close: Callable[[Connection], None],
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.on_close = on_close
+        self.pending: deque[tuple[Parser, asyncio.Future[Any]]] = deque()
+        self.closed = False
+        self.wakeup: asyncio.Event = asyncio.Event()
+        self.task = asyncio.create_task(self.read_loop())
+
+    def request(self, payload: bytes, parser: Parser | None) -> asyncio.Future[Any]:
+        future = asyncio.get_running_loop().create_future()
+        if self.closed:
+            future.set_exception(MemcacheError("Connection is closed"))
+            return future
+        self.writer.write(payload)
+        if parser is None:
+            future.set_result(None)
+        else:
+            self.pending.append((parser, future))
+            self.wakeup.set()
+        return future
+
+    async def read_loop(self) -> None:
+        error: BaseException = MemcacheError("Connection is closed")
+        try:
+            while True:
+                if not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                parser, future = self.pending[0]
+                try:
+                    result = await parser(self.reader)
+                except _ServerError as e:
+                    self.pending.popleft()
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                self.pending.popleft()
+                # The caller may have given up (cancelled), the reply must still be
+                # consumed to keep the connection in sync.
+                if not future.done():
+                    future.set_result(result)
+        except (OSError, EOFError, ValueError, MemcacheError) as e:
+            error = e
+        finally:
+            self.close(error)
+
+    def close(self, error: BaseException | None = None) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        while self.pending:
+            _, future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error or MemcacheError("Connection is closed"))
+        self.task.cancel()
+        self.on_close(self)
+
+
+class Memcache:
+    def __init__(
+        self,
+        address: tuple[str, int] | str,
+        *,
+        pool_size: int = 4,
+        timeout: float | None = 5.0,
+        default_noreply: bool = True,
+        serde: Serde | None = None,
+    ) -> None:
+        """Initialize an asyncio memcached client.
+
+        Concurrent requests are pipelined over a bounded pool of connections which
+        are opened lazily.
+
+        Args:
+        ----
+            address: (host, port), "host:port" or the path to a unix socket.
+            pool_size: The maximum number of connections.
+            timeout: Timeout in seconds for connecting and for each request.
+            default_noreply: Don't wait for replies of storage commands by default.
+            serde: The serializer for values, msgpack by default.
+
+        """
+        self.address = normalize_server_spec(address)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.default_noreply = default_noreply
+        self.serde = serde or MsgpackSerde()
+        self.connections: list[Connection] = []
+        self.connecting: set[asyncio.Task[Connection]] = set()
+        # Requests which waited for a reply, noreply writes are not counted.
+        self.round_trips = 0
+
+    async def open_connection(self) -> Connection:
+        async with asyncio.timeout(self.timeout):
+            if isinstance(self.address, str):
+                reader, writer = await asyncio.open_unix_connection(self.address)
+            else:
+                reader, writer = await asyncio.open_connection(*self.address)
+        connection = Connection(reader, writer, self.connections.remove)
+        self.connections.append(connection)
+        return connection
+
+    async def connect(self) -> None:
+        """Open the whole pool up front instead of on the first requests."""
+        missing = self.pool_size - len(self.connections) - len(self.connecting)
+        await asyncio.gather(*(self.open_connection() for _ in range(missing)))
+
+    async def acquire(self) -> Connection:
+        """Return the least busy connection, opening a new one if all are busy."""
+        for connection in list(self.connections):
+            if connection.reader.at_eof() or connection.writer.is_closing():
+                connection.close()
+        connection = min(
+            self.connections,
+            key=lambda connection: len(connection.pending),
+            default=None,
+        )
+        total = len(self.connections) + len(self.connecting)
+        if connection is not None and (
+            not connection.pending or total >= self.pool_size
+        ):
+            return connection
+        if total < self.pool_size:
+            task = asyncio.create_task(self.open_connection())
+            self.connecting.add(task)
+            task.add_done_callback(self.connecting.discard)
+        else:
+            task = next(iter(self.connecting))
+        return await asyncio.shield(task)
+
+    async def execute(self, payload: bytes, parser: Parser | None) -> Any:
+        connection = await self.acquire()
+        future = connection.request(payload, parser)
+        if parser is None:
+            await connection.writer.drain()
+            return None
+        self.round_trips += 1
+        async with asyncio.timeout(self.timeout):
+            return await future
+
+    async def close(self) -> None:
+        """Close all connections."""
+        for task in list(self.connecting):
+            task.cancel()
+        for connection in list(self.connections):
+            connection.close()
+            await connection.writer.wait_closed()
+
+    def serialize(self, key: str, value: Any) -> tuple[bytes, int]:
+        return self.serde.serialize(key, value)
+
+    def deserialize(self, key: bytes, value: bytes, flags: int, as_type: Any) -> Any:
+        return self.serde.deserialize(key.decode(), value, flags, as_type)
+
+    def storage_command(
+        self,
+        name: bytes,
+        key: str,
+        value: Any,
+        expire: int,
+        *,
+        noreply: bool,
+        cas: int | None = None,
+    ) -> bytes:
+        data, flags = self.serialize(key, value)
+        return b"%s %s %d %d %d%s%s\r\n%s\r\n" % (
+            name,
+            encode_key(key),
+            flags,
+            expire,
+            len(data),
+            b"" if cas is None else b" %d" % cas,
+            b" noreply" if noreply else b"",
+            data,
+        )
+
+    async def store(
+        self, name: bytes, key: str, value: Any, expire: int, noreply: bool | None
+    ) -> bool:
+        if noreply is None:
+            noreply = self.default_noreply
+        command = self.storage_command(name, key, value, expire, noreply=noreply)
+        if noreply:
+            await self.execute(command, None)
+            return True
+        return await self.execute(command, read_stored)
+
+    async def get(self, key: str, default: Any = None, as_type: Any = Any) -> Any:
+        """Get the value of a key, return default if not found.
+
+        `as_type` is the expected type of the value, serdes which support it decode
+        directly into it.
+        """
+        encoded = encode_key(key)
+        values = await self.execute(
+            b"get %s\r\n" % encoded, partial(read_values, keys=(encoded,))
+        )
+        if not values:
+            return default
+        ((encoded, (value, flags, _)),) = values.items()
+        return self.deserialize(encoded, value, flags, as_type)
+
+    async def gets(
+        self, key: str, default: Any = None, as_type: Any = Any
+    ) -> tuple[Any, int | None]:
+        """Get the value of a key and its CAS token, (default, None) if not found.
+
+        The token is passed to `cas` to store a new value only if nobody else
+        modified it in between.
+        """
+        encoded = encode_key(key)
+        values = await self.execute(
+            b"gets %s\r\n" % encoded, partial(read_values, keys=(encoded,))
+        )
+        if not values:
+            return default, None
+        ((encoded, (value, flags, cas)),) = values.items()
+        return self.deserialize(encoded, value, flags, as_type), cas
+
+    async def get_many(self, keys: Iterable[str], as_type: Any = Any) -> dict[str, Any]:
+        """Get the values of several keys in one request, missing keys are omitted."""
+        encoded = [encode_key(key) for key in keys]
+        if not encoded:
+            return {}
+        values = await self.execute(
+            b"get %s\r\n" % b" ".join(encoded), partial(read_values, keys=set(encoded))
+        )
+        return {
+            key.decode(): self.deserialize(key, value, flags, as_type)
+            for key, (value, flags, _) in values.items()
+        }
+
+    async def set(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool:
+        """Store a value."""
+        return await self.store(b"set", key, value, expire, noreply)
+
+    async def add(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool:
+        """Store a value only if the key does not exist."""
+        return await self.store(b"add", key, value, expire, noreply)
+
+    async def replace(
+        self, key: str, value: Any, expire: int = 0, noreply: bool | None = None
+    ) -> bool:
+        """Store a value only if the key already exists."""
+        return await self.store(b"replace", key, value, expire, noreply)
+
+    async def cas(
+        self, key: str, value: Any, cas: int, expire: int = 0, noreply: bool = False
+    ) -> bool:
+        """Store a value only if its CAS token is still `cas`, return True if stored.
+
+        A negative `expire` deletes the key under the same condition.
+        """
+        command = self.storage_command(
+            b"cas", key, value, expire, noreply=noreply, cas=cas
+        )
+        if noreply:
+            await self.execute(command, None)
+            return True
+        return await self.execute(command, read_stored)
+
+    async def incr(self, key: str, value: int, noreply: bool = False) -> int | None:
+        """Increment a counter, return the new value or None if not found."""
+        command = b"incr %s %d%s\r\n" % (
+            encode_key(key),
+            value,
+            b" noreply" if noreply else b"",
+        )
+        return await self.execute(command, None if noreply else read_number)
+
+    async def decr(self, key: str, value: int, noreply: bool = False) -> int | None:
+        """Decrement a counter, return the new value or None if not found."""
+        command = b"decr %s %d%s\r\n" % (
+            encode_key(key),
+            value,
+            b" noreply" if noreply else b"",
+        )
+        return await self.execute(command, None if noreply else read_number)
+
+    async def delete(self, key: str, noreply: bool | None = None) -> bool:
+        """Delete a key, return True if it existed."""
+        if noreply is None:
+            noreply = self.default_noreply
+        if noreply:
+            await self.execute(b"delete %s noreply\r\n" % encode_key(key), None)
+            return True
+        return await self.execute(b"delete %s\r\n" % encode_key(key), read_deleted)
+
+    async def delete_many(
+        self, keys: Iterable[str], noreply: bool | None = None
+    ) -> bool:
+        """Delete several keys in one pipelined request."""
+        if noreply is None:
+            noreply = self.default_noreply
+        encoded = [encode_key(key) for key in keys]
+        if not encoded:
+            return True
+        if noreply:
+            await self.execute(
+                b"".join(b"delete %s noreply\r\n" % key for key in encoded), None
+            )
+            return True
+        await self.execute(
+            b"".join(b"delete %s\r\n" % key for key in encoded),
+            read_all(*(read_deleted for _ in encoded)),
+        )
+        return True
+
+    async def touch(self, key: str, expire: int, noreply: bool | None = None) -> bool:
+        """Update the expiration time of a key, return True if it existed."""
+        if noreply is None:
+            noreply = self.default_noreply
+        if noreply:
+            await self.execute(
+                b"touch %s %d noreply\r\n" % (encode_key(key), expire), None
+            )
+            return True
+        return await self.execute(
+            b"touch %s %d\r\n" % (encode_key(key), expire), read_touched
+        )
+
+    def pipeline(self) -> Pipeline:
+        """Batch several commands into a single round trip.
+
+        Usage:
+        >>> pipeline = memcache.pipeline()
+        >>> pipeline.add("counter", 0, expire=60, noreply=True)
+        >>> pipeline.incr("counter", 1)
+        >>> [count] = await pipeline.execute()
+        """
+        return Pipeline(self)
+
+    async def rate_limit(self, accessor: str, resource: str, limit: RateLimit) -> bool:
         """Rate limit an accessor for a resource.
 
         Returns True if the accessor is NOT allowed to access the resource.
@@ -15,11 +477,117 @@ class Memcache(Client):
         ----
             accessor: The accessor to rate limit.
             resource: The resource to rate limit.
-            rate: The rate limit in seconds.
+            limit: The rate limiting algorithm and its parameters.
 
         """
-        lock = self.get(f"accessor={accessor};resource={resource}")
-        if lock:
-            return True
-        self.set(f"accessor={accessor};resource={resource}", True, expire=rate)
-        return False
+        return await limit.exceeded(self, f"accessor={accessor};resource={resource}")
+
+
+class Pipeline:
+    """Commands queued to be sent to memcached in one write.
+
+    Commands with noreply=True don't produce a result, execute() returns the
+    results of the remaining commands in order.
+    """
+
+    def __init__(self, memcache: Memcache) -> None:
+        self.memcache = memcache
+        self.commands: list[bytes] = []
+        self.parsers: list[Parser] = []
+
+    def store(
+        self,
+        name: bytes,
+        key: str,
+        value: Any,
+        expire: int,
+        *,
+        noreply: bool,
+        cas: int | None = None,
+    ) -> None:
+        self.commands.append(
+            self.memcache.storage_command(
+                name, key, value, expire, noreply=noreply, cas=cas
+            )
+        )
+        if not noreply:
+            self.parsers.append(read_stored)
+
+    def set(self, key: str, value: Any, expire: int = 0, noreply: bool = False) -> None:
+        self.store(b"set", key, value, expire, noreply=noreply)
+
+    def add(self, key: str, value: Any, expire: int = 0, noreply: bool = False) -> None:
+        self.store(b"add", key, value, expire, noreply=noreply)
+
+    def cas(
+        self, key: str, value: Any, cas: int, expire: int = 0, noreply: bool = False
+    ) -> None:
+        self.store(b"cas", key, value, expire, noreply=noreply, cas=cas)
+
+    def get(self, key: str, default: Any = None, as_type: Any = Any) -> None:
+        deserialize = self.memcache.deserialize
+        requested = encode_key(key)
+
+        async def parse(reader: asyncio.StreamReader) -> Any:
+            values = await read_values(reader, (requested,))
+            if not values:
+                return default
+            ((encoded, (value, flags, _)),) = values.items()
+            return deserialize(encoded, value, flags, as_type)
+
+        self.commands.append(b"get %s\r\n" % requested)
+        self.parsers.append(parse)
+
+    def gets(self, key: str, default: Any = None, as_type: Any = Any) -> None:
+        """Queue a gets, its result is a (value, CAS token) tuple."""
+        deserialize = self.memcache.deserialize
+        requested = encode_key(key)
+
+        async def parse(reader: asyncio.StreamReader) -> tuple[Any, int | None]:
+            values = await read_values(reader, (requested,))
+            if not values:
+                return default, None
+            ((encoded, (value, flags, cas)),) = values.items()
+            return deserialize(encoded, value, flags, as_type), cas
+
+        self.commands.append(b"gets %s\r\n" % requested)
+        self.parsers.append(parse)
+
+    def counter(self, name: bytes, key: str, value: int, *, noreply: bool) -> None:
+        self.commands.append(
+            b"%s %s %d%s\r\n"
+            % (name, encode_key(key), value, b" noreply" if noreply else b"")
+        )
+        if not noreply:
+            self.parsers.append(read_number)
+
+    def incr(self, key: str, value: int, noreply: bool = False) -> None:
+        self.counter(b"incr", key, value, noreply=noreply)
+
+    def decr(self, key: str, value: int, noreply: bool = False) -> None:
+        self.counter(b"decr", key, value, noreply=noreply)
+
+    def delete(self, key: str, noreply: bool = False) -> None:
+        self.commands.append(
+            b"delete %s%s\r\n" % (encode_key(key), b" noreply" if noreply else b"")
+        )
+        if not noreply:
+            self.parsers.append(read_deleted)
+
+    def touch(self, key: str, expire: int, noreply: bool = False) -> None:
+        self.commands.append(
+            b"touch %s %d%s\r\n"
+            % (encode_key(key), expire, b" noreply" if noreply else b"")
+        )
+        if not noreply:
+            self.parsers.append(read_touched)
+
+    async def execute(self) -> list[Any]:
+        commands, parsers = self.commands, self.parsers
+        self.commands, self.parsers = [], []
+        if not commands:
+            return []
+        if not parsers:
+            await self.memcache.execute(b"".join(commands), None)
+            return []
+        return await self.memcache.execute(b"".join(commands), read_all(*parsers))
@@ -1,10 +1,22 @@
-from collections.abc import Awaitable, Callable
-from inspect import signature
+from collections.abc import Callable, Sequence
+from inspect import isasyncgenfunction, iscoroutinefunction, signature
 from types import UnionType
-from typing import Any, get_origin, get_type_hints
+from typing import Any, Literal, get_origin, get_type_hints, overload
 
 import msgspec
 
+from .concurrency import ConcurrencyLimit
+from .rate_limit import FixedWindow, RateLimit
+from .result_cache import (
+    LocalCache,
+    ResultCache,
+    depends_on_session,
+    template_names,
+)
+from .streams import RequestBody
+
+type ExecutorKind = Literal["thread", "process"]
+
 
 class Method(msgspec.Struct):
     implementation: Any
@@ -12,7 +24,21 @@ class Method(msgspec.Struct):
     decoder: msgspec.json.Decoder[Any]
     type_hints: dict[str, Any]
     parameter_session_optional: bool
-    rate_limit: int = 0
+    invoke: Callable[..., Any]
+    has_parameters: bool
+    uses_session: bool
+    uses_credentials: bool
+    rate_limit: RateLimit | None = None
+    max_body_size: int | None = None
+    body_parameter: str | None = None
+    streaming: bool = False
+    cache: ResultCache | None = None
+    tags: tuple[str, ...] = ()
+    invalidates: tuple[str, ...] = ()
+    compress: bool = True
+    executor: ExecutorKind | None = None
+    limit: ConcurrencyLimit | None = None
+    priority: str = "default"
 
 
 methods: dict[str, Method] = {}
@@ -26,8 +52,54 @@ def snake_to_pascal(snake: str) -> str:
 SPECIAL_PARAMETERS = ["return", "session", "credentials"]
 
 
-def method[**P, R](func: Callable[P, Awaitable[R]], rate_limit : int) -> Callable[P, Awaitable[R]]:
+def compile_invoker(
+    func: Callable[..., Any],
+    fields: tuple[str, ...],
+    *,
+    session: bool,
+    credentials: bool,
+    body_parameter: str | None,
+) -> Callable[..., Any]:
+    """Compile `invoke(parameters, session, credentials, body)` calling `func`.
+
+    The fields of the parameters struct and the special parameters the function
+    takes are passed as keyword arguments spelled out in the generated code, so
+    no kwargs dict is built per call.
+    """
+    arguments = [f"{field}=parameters.{field}" for field in fields]
+    if session:
+        arguments.append("session=session")
+    if credentials:
+        arguments.append("credentials=credentials")
+    if body_parameter is not None:
+        arguments.append(f"{body_parameter}=body")
+    source = (
+        "def invoke(parameters, session, credentials, body):\n"
+        f"    return func({', '.join(arguments)})\n"
+    )
+    namespace: dict[str, Any] = {"func": func}
+    exec(compile(source, f"<reproca invoker {func.__name__}>", "exec"), namespace)  # noqa: S102
+    return namespace["invoke"]
+
+
+def register[F: Callable[..., Any]](
+    func: F,
+    rate_limit: RateLimit | int | None,
+    max_body_size: int | None,
+    cache: ResultCache | float | None,
+    tags: Sequence[str],
+    invalidates: Sequence[str],
+    compress: bool,
+    executor: ExecutorKind | None,
+    max_concurrency: int | None,
+    max_queue: int,
+    queue_delay: float | None,
+    priority: str,
+) -> F:
     type_hints = get_type_hints(func)
+    body_parameter = next(
+        (key for key, value in type_hints.items() if value is RequestBody), None
+    )
     type_ = msgspec.defstruct(
         snake_to_pascal(func.__name__) + "Parameters",
         (
@@ -35,20 +107,239 @@ def method[**P, R](func: Callable[P, Awaitable[R]], rate_limit : int) -> Callabl
             if value.default is value.empty
             else (key, type_hints[value.name], value.default)
             for key, value in signature(func).parameters.items()
-            if key not in SPECIAL_PARAMETERS
+            if key not in SPECIAL_PARAMETERS and key != body_parameter
         ),
     )
     parameter_session_optional = False
     if (obj := type_hints.get("session")) and get_origin(obj) is UnionType:
         parameter_session_optional = True
+    if isinstance(rate_limit, int):
+        # One call per `rate_limit` seconds.
+        rate_limit = FixedWindow(1, rate_limit) if rate_limit > 0 else None
+    uses_session = "session" in type_hints
+    uses_credentials = "credentials" in type_hints
+    streaming = isasyncgenfunction(func)
+    if isinstance(cache, int | float):
+        cache = LocalCache(cache)
+    if cache is not None and (
+        streaming or uses_credentials or body_parameter is not None
+    ):
+        msg = (
+            f"Method {func.__name__!r} can't be cached, it streams or takes "
+            "credentials or a request body"
+        )
+        raise ValueError(msg)
+    if tags and cache is None:
+        msg = f"Method {func.__name__!r} has tags but is not cached"
+        raise ValueError(msg)
+    if cache is not None and not cache.per_session and uses_session:
+        # Otherwise one user's result would be served to every other user.
+        msg = (
+            f"Method {func.__name__!r} takes the session, its cache must be per_session"
+        )
+        raise ValueError(msg)
+    if cache is not None and not cache.per_session and depends_on_session(tags):
+        msg = (
+            f"Method {func.__name__!r} has tags depending on the session, its "
+            "cache must be per_session"
+        )
+        raise ValueError(msg)
+    try:
+        names = template_names([*tags, *invalidates])
+    except ValueError as e:
+        msg = f"Method {func.__name__!r} has a malformed tag: {e}"
+        raise ValueError(msg) from e
+    if unknown := names - {*type_.__struct_fields__, "session"}:
+        # Formatting them would fail on every call, after the method ran for
+        # invalidated tags.
+        msg = (
+            f"Method {func.__name__!r} has tags referring to {sorted(unknown)}, "
+            "which are neither parameters nor the session"
+        )
+        raise ValueError(msg)
+    if cache is not None and invalidates:
+        # Cached results are returned before the method could invalidate tags.
+        msg = f"Method {func.__name__!r} is cached and can't invalidate tags"
+        raise ValueError(msg)
+    if invalidates and streaming:
+        msg = f"Method {func.__name__!r} streams and can't invalidate tags"
+        raise ValueError(msg)
+    if executor is not None and (
+        streaming or iscoroutinefunction(func) or body_parameter is not None
+    ):
+        msg = (
+            f"Method {func.__name__!r} runs in a {executor} pool, it must be a "
+            "regular function without a request body"
+        )
+        raise ValueError(msg)
+    if executor is None and not (streaming or iscoroutinefunction(func)):
+        msg = (
+            f"Method {func.__name__!r} is a regular function, it must be async or "
+            'run in an executor, e.g. executor="thread"'
+        )
+        raise ValueError(msg)
+    if max_concurrency is None and (max_queue or queue_delay is not None):
+        msg = f"Method {func.__name__!r} has a queue but no max_concurrency"
+        raise ValueError(msg)
+    if executor == "process" and uses_credentials:
+        msg = f"Method {func.__name__!r} runs in a process and can't take credentials"
+        raise ValueError(msg)
 
-    # Add rate_limit to Method object
     methods[f"/{func.__name__}"] = Method(
         implementation=func,
         type=type_,
         decoder=msgspec.json.Decoder(type=type_),
         type_hints=type_hints,
         parameter_session_optional=parameter_session_optional,
+        invoke=compile_invoker(
+            func,
+            type_.__struct_fields__,
+            session=uses_session,
+            credentials=uses_credentials,
+            body_parameter=body_parameter,
+        ),
+        has_parameters=bool(type_.__struct_fields__),
+        uses_session=uses_session,
+        uses_credentials=uses_credentials,
         rate_limit=rate_limit,
+        max_body_size=max_body_size,
+        body_parameter=body_parameter,
+        streaming=streaming,
+        cache=cache,
+        tags=tuple(tags),
+        invalidates=tuple(invalidates),
+        compress=compress,
+        executor=executor,
+        limit=None
+        if max_concurrency is None
+        else ConcurrencyLimit(max_concurrency, max_queue, target_delay=queue_delay),
+        priority=priority,
     )
     return func
+
+
+@overload
+def method[F: Callable[..., Any]](func: F, /) -> F: ...
+
+
+@overload
+def method[F: Callable[..., Any]](
+    *,
+    rate_limit: RateLimit | int | None = None,
+    max_body_size: int | None = None,
+    cache: ResultCache | float | None = None,
+    tags: Sequence[str] = (),
+    invalidates: Sequence[str] = (),
+    compress: bool = True,
+    executor: ExecutorKind | None = None,
+    max_concurrency: int | None = None,
+    max_queue: int = 0,
+    queue_delay: float | None = None,
+    priority: str = "default",
+) -> Callable[[F], F]: ...
+
+
+def method[F: Callable[..., Any]](
+    func: F | None = None,
+    /,
+    *,
+    rate_limit: RateLimit | int | None = None,
+    max_body_size: int | None = None,
+    cache: ResultCache | float | None = None,
+    tags: Sequence[str] = (),
+    invalidates: Sequence[str] = (),
+    compress: bool = True,
+    executor: ExecutorKind | None = None,
+    max_concurrency: int | None = None,
+    max_queue: int = 0,
+    queue_delay: float | None = None,
+    priority: str = "default",
+) -> F | Callable[[F], F]:
+    """Register an async function as a reproca method.
+
+    Async generator functions are streamed to the client as newline-delimited JSON.
+    Blocking or CPU-bound work is registered as a regular function run in a pool.
+
+    Usage:
+    >>> @method
+    ... async def get_todos() -> list[Todo]: ...
+    >>> @method(rate_limit=TokenBucket(rate=5, burst=10))
+    ... async def create_todo(title: str) -> str: ...
+    >>> @method
+    ... async def export_todos() -> AsyncIterator[Todo]:
+    ...     for todo in todos:
+    ...         yield todo
+    >>> @method(
+    ...     cache=MemcacheCache(ttl=60, per_session=True),
+    ...     tags=["todos:{session.userid}"],
+    ... )
+    ... async def get_todos(session: User) -> list[Todo]: ...
+    >>> @method(invalidates=["todos:{session.userid}"])
+    ... async def create_todo(session: User, title: str) -> str: ...
+    >>> @method(executor="process")
+    ... def render_invoice(invoice: Invoice) -> bytes: ...
+    >>> @method(max_concurrency=20, max_queue=100, queue_delay=0.05)
+    ... async def search(query: str) -> list[Result]: ...
+    >>> @method(priority="bulk")
+    ... async def export_report(month: str) -> Report: ...
+
+    Args:
+    ----
+        func: The function to register.
+        rate_limit: The rate limiting algorithm applied per client address, an int
+            allows one call per that many seconds.
+        max_body_size: The maximum request body size in bytes, defaults to the
+            app's limit.
+        cache: Serve the encoded result from this cache, a number caches it in
+            process for that many seconds. Only for methods without side effects,
+            the cache of methods taking the session must be per_session.
+        tags: Tags the cached result depends on, formatted with the parameters and
+            the session.
+        invalidates: Tags invalidated when the method returns without raising.
+        compress: Compress large responses if the client accepts it, disable for
+            results which are already compact, like images or random tokens.
+        executor: Run the function in the app's thread pool or process pool
+            instead of awaiting it, required for functions which aren't async.
+            Parameters, session and result of a function run in a process must
+            be encodable by msgspec, and the function must be importable from
+            its module.
+        max_concurrency: The maximum number of calls of the method running at
+            once in this worker, unlimited if None.
+        max_queue: The maximum number of calls waiting for one of the running
+            calls to complete, further calls are rejected with a 503 and a
+            Retry-After header.
+        queue_delay: Shed load adaptively, rejecting calls which would queue
+            while calls keep waiting longer than this many seconds.
+        priority: The priority class of the method, which the app's scheduler
+            admits calls by when the worker is busy.
+
+    """
+    if func is not None:
+        return register(
+            func,
+            rate_limit,
+            max_body_size,
+            cache,
+            tags,
+            invalidates,
+            compress,
+            executor,
+            max_concurrency,
+            max_queue,
+            queue_delay,
+            priority,
+        )
+    return lambda func: register(
+        func,
+        rate_limit,
+        max_body_size,
+        cache,
+        tags,
+        invalidates,
+        compress,
+        executor,
+        max_concurrency,
+        max_queue,
+        queue_delay,
+        priority,
+    )
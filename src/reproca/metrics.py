@@ -0,0 +1,232 @@
+"""Per-method request metrics exposed in the Prometheus text format.
+
+Every worker process records into its own array of 64-bit integers, mapped
+from a file when a directory is given. Rendering sums the arrays of all the
+workers sharing the directory, so any worker can serve the metrics of all.
+"""
+
+from __future__ import annotations
+
+__all__ = ["Metrics"]
+
+import hashlib
+import mmap
+import os
+from bisect import bisect_left
+from http import HTTPStatus
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .method import methods
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+# Statuses counted as errors, anything else that is not 200 counts as "other".
+# 499 counts calls cancelled because the client disconnected, like nginx does.
+ERROR_STATUSES = (400, 401, 413, 426, 429, 499, 500, 503, 504)
+# Upper bounds of the latency buckets in seconds, the last bucket is +Inf.
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+BUCKETS_NS = [round(bucket * 1e9) for bucket in BUCKETS]
+
+# Layout of the integers recorded for one path.
+COUNT = 0
+ERRORS = 1
+OTHER_ERRORS = ERRORS + len(ERROR_STATUSES)
+REQUEST_BYTES = OTHER_ERRORS + 1
+RESPONSE_BYTES = REQUEST_BYTES + 1
+DURATION_NS = RESPONSE_BYTES + 1
+HISTOGRAM = DURATION_NS + 1
+SLOT_SIZE = HISTOGRAM + len(BUCKETS) + 1
+
+ERROR_INDEX = {status: ERRORS + i for i, status in enumerate(ERROR_STATUSES)}
+UNKNOWN = "unknown"
+
+
+class Metrics:
+    def __init__(self, directory: str | os.PathLike[str] | None = None) -> None:
+        """Initialize per-method metrics.
+
+        The recorded paths are the methods registered when the first call is
+        recorded, calls to other paths are recorded as "unknown".
+
+        Args:
+        ----
+            directory: Where worker processes keep their metrics files, to
+                aggregate the metrics of all of them. Metrics are only kept in
+                memory and reported for this process if None.
+
+        """
+        self.directory = None if directory is None else Path(directory)
+        self.paths: list[str] = []
+        self.slots: dict[str, int] = {}
+        self.memory: mmap.mmap | None = None
+        self.values: memoryview | None = None
+        self.extra_paths: list[str] = []
+        self.gauges: list[tuple[str, str, Callable[[], dict[str, float]]]] = []
+        os.register_at_fork(after_in_child=self.close)
+
+    def add_path(self, path: str) -> None:
+        """Record calls to a path other than a method, like the batch route."""
+        self.extra_paths.append(path)
+        self.close()
+
+    def add_gauge(
+        self, name: str, help_: str, sample: Callable[[], dict[str, float]]
+    ) -> None:
+        """Report values of this process sampled on rendering, by label set.
+
+        Usage:
+        >>> metrics.add_gauge("queue", "Queued calls.", lambda: {'pool="a"': 1})
+        """
+        self.gauges.append((name, help_, sample))
+
+    @property
+    def layout(self) -> str:
+        """A digest of the recorded paths, workers share files with the same one."""
+        digest = hashlib.blake2b("\n".join(self.paths).encode(), digest_size=8)
+        return digest.hexdigest()
+
+    def open(self) -> memoryview:
+        """Allocate the array of this process, a file if there is a directory."""
+        self.paths = [*sorted(methods), *self.extra_paths, UNKNOWN]
+        self.slots = {path: i * SLOT_SIZE for i, path in enumerate(self.paths)}
+        size = len(self.paths) * SLOT_SIZE * 8
+        if self.directory is None:
+            self.memory = mmap.mmap(-1, size)
+        else:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            file = self.directory / f"reproca-{self.layout}-{os.getpid()}.bin"
+            fd = os.open(file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self.memory = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        self.values = memoryview(self.memory).cast("q")
+        return self.values
+
+    def close(self) -> None:
+        """Forget the array, the next call opens a new one, e.g. after a fork."""
+        if self.values is not None:
+            self.values.release()
+        self.values = None
+        self.memory = None
+
+    def record(
+        self,
+        path: str,
+        status: int,
+        request_bytes: int,
+        response_bytes: int,
+        duration_ns: int,
+    ) -> None:
+        """Record a call, updating the preallocated array in place."""
+        values = self.values
+        if values is None:
+            values = self.open()
+        slot = self.slots.get(path)
+        if slot is None:
+            slot = self.slots[UNKNOWN]
+        values[slot + COUNT] += 1
+        if status != HTTPStatus.OK:
+            values[slot + ERROR_INDEX.get(status, OTHER_ERRORS)] += 1
+        values[slot + REQUEST_BYTES] += request_bytes
+        values[slot + RESPONSE_BYTES] += response_bytes
+        values[slot + DURATION_NS] += duration_ns
+        values[slot + HISTOGRAM + bisect_left(BUCKETS_NS, duration_ns)] += 1
+
+    def collect(self) -> list[int]:
+        """Sum the arrays of all the workers."""
+        values = self.values
+        if values is None:
+            values = self.open()
+        if self.directory is None:
+            return values.tolist()
+        totals = [0] * len(values)
+        for file in self.directory.glob(f"reproca-{self.layout}-*.bin"):
+            with (
+                file.open("rb") as f,
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as memory,
+                memoryview(memory) as view,
+                view[: len(totals) * 8].cast("q") as other,
+            ):
+                for i, value in enumerate(other):
+                    totals[i] += value
+        return totals
+
+    def render(self) -> bytes:
+        """Render the metrics in the Prometheus text exposition format."""
+        totals = self.collect()
+        lines = [
+            "# HELP reproca_requests_total Calls by method.",
+            "# TYPE reproca_requests_total counter",
+        ]
+        lines.extend(
+            f'reproca_requests_total{{method="{path}"}} {totals[slot + COUNT]}'
+            for path, slot in self.slots.items()
+        )
+        lines += [
+            "# HELP reproca_errors_total Failed calls by method and status.",
+            "# TYPE reproca_errors_total counter",
+        ]
+        for path, slot in self.slots.items():
+            for status, index in (*ERROR_INDEX.items(), ("other", OTHER_ERRORS)):
+                if count := totals[slot + index]:
+                    lines.append(
+                        f'reproca_errors_total{{method="{path}",status="{status}"}} '
+                        f"{count}"
+                    )
+        for name, index, help_ in (
+            ("request_bytes", REQUEST_BYTES, "Request body bytes by method."),
+            ("response_bytes", RESPONSE_BYTES, "Response body bytes by method."),
+        ):
+            lines += [
+                f"# HELP reproca_{name}_total {help_}",
+                f"# TYPE reproca_{name}_total counter",
+            ]
+            lines.extend(
+                f'reproca_{name}_total{{method="{path}"}} {totals[slot + index]}'
+                for path, slot in self.slots.items()
+            )
+        lines += [
+            "# HELP reproca_request_duration_seconds Call latency by method.",
+            "# TYPE reproca_request_duration_seconds histogram",
+        ]
+        for path, slot in self.slots.items():
+            cumulative = 0
+            for i, bucket in enumerate((*BUCKETS, "+Inf")):
+                cumulative += totals[slot + HISTOGRAM + i]
+                lines.append(
+                    f'reproca_request_duration_seconds_bucket{{method="{path}",'
+                    f'le="{bucket}"}} {cumulative}'
+                )
+            seconds = totals[slot + DURATION_NS] / 1e9
+            count = totals[slot + COUNT]
+            lines += [
+                f'reproca_request_duration_seconds_sum{{method="{path}"}} {seconds}',
+                f'reproca_request_duration_seconds_count{{method="{path}"}} {count}',
+            ]
+        for name, help_, sample in self.gauges:
+            lines += [f"# HELP {name} {help_}", f"# TYPE {name} gauge"]
+            lines.extend(
+                f"{name}{{{labels}}} {value}" for labels, value in sample().items()
+            )
+        lines.append("")
+        return "\n".join(lines).encode()
@@ -0,0 +1,100 @@
+"""Rate limiting algorithms built on atomic memcached counters.
+
+Every algorithm decides with a single round trip: the counter is created with
+``add`` and updated with ``incr`` in the same pipelined write, so concurrent
+requests from several workers are counted exactly once.
+"""
+
+from __future__ import annotations
+
+__all__ = ["FixedWindow", "RateLimit", "SlidingWindow", "TokenBucket"]
+
+import math
+import time
+from typing import TYPE_CHECKING, Protocol
+
+import msgspec
+
+if TYPE_CHECKING:
+    from .backend import Backend
+
+
+class RateLimit(Protocol):
+    """A rate limiting algorithm."""
+
+    async def exceeded(self, memcache: Backend, key: str) -> bool:
+        """Count a request, return True if it is NOT allowed."""
+        ...
+
+
+class FixedWindow(msgspec.Struct, frozen=True):
+    """Allow `limit` requests per `window` seconds, counted in aligned windows."""
+
+    limit: int
+    window: int
+
+    async def exceeded(self, memcache: Backend, key: str) -> bool:
+        key = f"{key};window={int(time.time() // self.window)}"
+        pipeline = memcache.pipeline()
+        pipeline.add(key, 0, expire=self.window, noreply=True)
+        pipeline.incr(key, 1)
+        [count] = await pipeline.execute()
+        return count is not None and count > self.limit
+
+
+class SlidingWindow(msgspec.Struct, frozen=True):
+    """Allow `limit` requests in any `window` seconds.
+
+    The count of the previous window is weighted by how much of it still overlaps
+    the sliding window, which approximates a sliding log without storing one.
+    """
+
+    limit: int
+    window: int
+
+    async def exceeded(self, memcache: Backend, key: str) -> bool:
+        index, elapsed = divmod(time.time(), self.window)
+        current = f"{key};window={int(index)}"
+        pipeline = memcache.pipeline()
+        pipeline.add(current, 0, expire=2 * self.window, noreply=True)
+        pipeline.incr(current, 1)
+        pipeline.get(f"{key};window={int(index) - 1}", 0)
+        count, previous = await pipeline.execute()
+        if count is None:
+            return False
+        if previous * (1 - elapsed / self.window) + count > self.limit:
+            # Rejected requests don't count towards the limit.
+            await memcache.decr(current, 1, noreply=True)
+            return True
+        return False
+
+
+class TokenBucket(msgspec.Struct, frozen=True):
+    """Allow `rate` requests per second on average with bursts of up to `burst`.
+
+    Implemented as the generic cell rate algorithm: the key holds the theoretical
+    arrival time in milliseconds, which every request pushes forward by one
+    emission interval. The key expires exactly when the bucket is full again.
+    """
+
+    rate: float
+    burst: int = 1
+
+    async def exceeded(self, memcache: Backend, key: str) -> bool:
+        now = int(time.time() * 1000)
+        interval = max(1, round(1000 / self.rate))
+        expire = math.ceil(self.burst * interval / 1000) + 1
+        pipeline = memcache.pipeline()
+        pipeline.add(key, now, expire=expire, noreply=True)
+        pipeline.incr(key, interval)
+        pipeline.touch(key, expire, noreply=True)
+        [arrival] = await pipeline.execute()
+        if arrival is None:
+            return False
+        if arrival - now > self.burst * interval:
+            await memcache.decr(key, interval, noreply=True)
+            return True
+        if arrival < now + interval:
+            # The bucket refilled since the last request, restart from now.
+            await memcache.set(key, now + interval, expire=expire, noreply=True)
+        return False
@@ -0,0 +1,252 @@
+"""Memoization of the encoded results of idempotent methods.
+
+Cached results can depend on tags, every tag has a generation counter in
+memcache which is part of the cache key. Invalidating a tag increments its
+counter, so results cached under the old generation are never served again and
+simply expire. Both operations take one round trip whatever the number of
+cached results, and work across workers.
+"""
+
+from __future__ import annotations
+
+__all__ = ["LocalCache", "MemcacheCache", "ResultCache", "invalidate"]
+
+import asyncio
+import hashlib
+import string
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any
+
+import msgspec
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Iterable, Sequence
+
+    from .backend import Backend
+
+encoder = msgspec.json.Encoder()
+# Whether a result cached for an encoding is compressed, in its first byte.
+IDENTITY = b"i"
+COMPRESSED = b"c"
+
+
+def tag_key(tag: str) -> str:
+    # Tags are formatted from parameters, which may not be valid keys.
+    return f"tag:{hashlib.blake2b(tag.encode(), digest_size=16).hexdigest()}"
+
+
+def format_tags(templates: Sequence[str], parameters: Any, session: Any) -> list[str]:
+    """Format tag templates like "todos:{session.userid}" for one call.
+
+    The templates can refer to the method's parameters by name and to `session`.
+    """
+    fields = {
+        name: getattr(parameters, name)
+        for name in getattr(parameters, "__struct_fields__", ())
+    }
+    return [
+        template.format_map({**fields, "session": session}) for template in templates
+    ]
+
+
+def template_names(templates: Sequence[str]) -> set[str]:
+    """Return the names tag templates refer to, "session" for "{session.userid}".
+
+    Raise ValueError if a template is malformed.
+    """
+    return {
+        field.split(".", 1)[0].split("[", 1)[0]
+        for template in templates
+        for _, field, _, _ in string.Formatter().parse(template)
+        if field is not None
+    }
+
+
+def depends_on_session(templates: Sequence[str]) -> bool:
+    """Return whether any tag template refers to the session."""
+    return "session" in template_names(templates)
+
+
+async def generations(memcache: Backend, tags: Iterable[str]) -> list[int]:
+    """Return the current generation of every tag.
+
+    A missing counter, never created or evicted, starts from the current time in
+    milliseconds rather than from 0, so that a generation is not reused.
+    """
+    now = time.time_ns() // 1_000_000
+    pipeline = memcache.pipeline()
+    for tag in tags:
+        key = tag_key(tag)
+        pipeline.add(key, now, noreply=True)
+        pipeline.get(key, 0, as_type=int)
+    return await pipeline.execute()
+
+
+async def invalidate(memcache: Backend, tags: Iterable[str]) -> None:
+    """Invalidate the cached results of all methods depending on any of `tags`.
+
+    Usage:
+    >>> await invalidate(memcache, [f"todos:{userid}"])
+    """
+    now = time.time_ns() // 1_000_000
+    pipeline = memcache.pipeline()
+    for tag in tags:
+        key = tag_key(tag)
+        pipeline.add(key, now, noreply=True)
+        pipeline.incr(key, 1)
+    await pipeline.execute()
+
+
+class ResultCache(ABC):
+    def __init__(self, ttl: float, *, per_session: bool = False) -> None:
+        """Initialize a cache of encoded method results.
+
+        Concurrent calls with the same key are collapsed into one execution of
+        the method, a miss doesn't cause a stampede.
+
+        Args:
+        ----
+            ttl: How long a result is served, in seconds.
+            per_session: Key results on the session user as well as on the
+                parameters, for methods whose result depends on the user.
+
+        """
+        self.ttl = ttl
+        self.per_session = per_session
+        self.inflight: dict[str, asyncio.Task[bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(
+        self,
+        path: str,
+        parameters: Any,
+        session: Any,
+        tags: Sequence[str] = (),
+        generations: Sequence[int] = (),
+    ) -> str:
+        """Return the cache key of a call from its decoded parameters.
+
+        `generations` are the generations of the formatted `tags` the result
+        depends on. The tags themselves are part of the key too: generations
+        start from the time, two tags can be at the same generation.
+        """
+        digest = hashlib.blake2b(encoder.encode(parameters), digest_size=16)
+        if self.per_session:
+            digest.update(b"\0")
+            digest.update(encoder.encode(session))
+        for tag, generation in zip(tags, generations, strict=True):
+            digest.update(b"\0%s\0%d" % (tag.encode(), generation))
+        return f"result:{path}:{digest.hexdigest()}"
+
+    @abstractmethod
+    async def get(self, memcache: Backend, key: str) -> bytes | None:
+        """Return the cached result of a key, None if missing."""
+
+    @abstractmethod
+    async def set(self, memcache: Backend, key: str, value: bytes) -> None:
+        """Cache the result of a key for `ttl` seconds."""
+
+    async def fetch(
+        self, memcache: Backend, key: str, compute: Callable[[], Awaitable[bytes]]
+    ) -> bytes:
+        """Return the cached result for `key`, computing and storing it on a miss."""
+        value = await self.get(memcache, key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(
+                self.compute(memcache, key, compute)
+            )
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # A caller giving up must not cancel the call the others are waiting for.
+        return await asyncio.shield(task)
+
+    async def fetch_compressed(
+        self,
+        memcache: Backend,
+        key: str,
+        compute: Callable[[], Awaitable[bytes]],
+        encoding: str,
+        compress: Callable[[bytes], bytes | None],
+    ) -> tuple[bytes, str | None]:
+        """Return the cached result compressed with `encoding` and the encoding.
+
+        The compressed result is cached next to the uncompressed one, so that it
+        is compressed only once. `compress` returns None for results not worth
+        compressing, which are returned as is with no encoding: they are cached
+        for the encoding too, so that a hit takes one lookup either way.
+        """
+        encoded_key = f"{key}:{encoding}"
+        entry = await self.get(memcache, encoded_key)
+        if entry is not None:
+            self.hits += 1
+            if entry.startswith(COMPRESSED):
+                return entry[1:], encoding
+            return entry[1:], None
+        value = await self.fetch(memcache, key, compute)
+        compressed = compress(value)
+        if compressed is None:
+            await self.set(memcache, encoded_key, IDENTITY + value)
+            return value, None
+        await self.set(memcache, encoded_key, COMPRESSED + compressed)
+        return compressed, encoding
+
+    async def compute(
+        self, memcache: Backend, key: str, compute: Callable[[], Awaitable[bytes]]
+    ) -> bytes:
+        value = await compute()
+        await self.set(memcache, key, value)
+        return value
+
+
+class LocalCache(ResultCache):
+    def __init__(
+        self, ttl: float, *, per_session: bool = False, max_entries: int = 1024
+    ) -> None:
+        """Initialize an in-process LRU cache of encoded method results.
+
+        Args:
+        ----
+            ttl: How long a result is served, in seconds.
+            per_session: Key results on the session user as well.
+            max_entries: The maximum number of cached results.
+
+        """
+        super().__init__(ttl, per_session=per_session)
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+
+    async def get(self, memcache: Backend, key: str) -> bytes | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, memcache: Backend, key: str, value: bytes) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class MemcacheCache(ResultCache):
+    """Cache encoded method results in memcache, shared by all workers.
+
+    Single-flight deduplication is still per worker.
+    """
+
+    async def get(self, memcache: Backend, key: str) -> bytes | None:
+        return await memcache.get(key, as_type=bytes)
+
+    async def set(self, memcache: Backend, key: str, value: bytes) -> None:
+        await memcache.set(key, value, expire=max(1, round(self.ttl)))
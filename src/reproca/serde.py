@@ -0,0 +1,79 @@
+"""Serializers for values stored in memcache."""
+
+from __future__ import annotations
+
+__all__ = ["MsgpackSerde", "PickleSerde", "Serde"]
+
+from typing import Any, Protocol
+
+import msgspec
+from pymemcache import serde
+
+FLAG_BYTES = serde.FLAG_BYTES
+FLAG_INTEGER = serde.FLAG_INTEGER
+FLAG_MSGPACK = 1 << 8
+
+
+class Serde(Protocol):
+    def serialize(self, key: str, value: Any) -> tuple[bytes, int]:
+        """Serialize a value, return the data and the flags to store with it."""
+        ...
+
+    def deserialize(
+        self, key: str, value: bytes, flags: int, as_type: Any = Any
+    ) -> Any:
+        """Deserialize stored data, `as_type` is the expected type of the value."""
+        ...
+
+
+class PickleSerde:
+    """Pickle values, compatible with pymemcache's pickle_serde."""
+
+    def serialize(self, key: str, value: Any) -> tuple[bytes, int]:
+        data, flags = serde.pickle_serde.serialize(key, value)
+        if isinstance(data, str):
+            data = data.encode()
+        return data, flags
+
+    def deserialize(
+        self, key: str, value: bytes, flags: int, as_type: Any = Any
+    ) -> Any:
+        return serde.pickle_serde.deserialize(key, value, flags)
+
+
+class MsgpackSerde:
+    """Encode values as msgpack, decoding them straight into the expected type.
+
+    Integers are stored as ASCII digits so that incr and decr work on them, bytes
+    are stored as is.
+    """
+
+    def __init__(self) -> None:
+        self.encoder = msgspec.msgpack.Encoder()
+        self.decoders: dict[Any, msgspec.msgpack.Decoder[Any]] = {}
+
+    def decoder(self, as_type: Any) -> msgspec.msgpack.Decoder[Any]:
+        try:
+            return self.decoders[as_type]
+        except KeyError:
+            decoder = self.decoders[as_type] = msgspec.msgpack.Decoder(as_type)
+            return decoder
+
+    def serialize(self, key: str, value: Any) -> tuple[bytes, int]:
+        if isinstance(value, bytes):
+            return value, FLAG_BYTES
+        if isinstance(value, int) and not isinstance(value, bool):
+            return b"%d" % value, FLAG_INTEGER
+        return self.encoder.encode(value), FLAG_MSGPACK
+
+    def deserialize(
+        self, key: str, value: bytes, flags: int, as_type: Any = Any
+    ) -> Any:
+        if flags & FLAG_MSGPACK:
+            return self.decoder(as_type).decode(value)
+        if flags & FLAG_INTEGER:
+            return int(value)
+        if flags == FLAG_BYTES:
+            return value
+        # Written by another serde.
+        return serde.pickle_serde.deserialize(key, value, flags)
@@ -2,16 +2,21 @@
 
 from __future__ import annotations
 
-__all__ = ["Sessions"]
+__all__ = ["SessionCache", "SessionStore", "Sessions"]
 
 import secrets
+import time
+import zlib
+from collections import OrderedDict
 from datetime import UTC, datetime
-from typing import TYPE_CHECKING
+from functools import cached_property
+from types import get_original_bases
+from typing import TYPE_CHECKING, Any, Protocol, get_args, get_origin
 
 import msgspec
 
 if TYPE_CHECKING:
-    from .memcache import Memcache
+    from .backend import Backend, BackendPipeline
 
 
 class Session[T, U](msgspec.Struct):
@@ -20,77 +25,345 @@ class Session[T, U](msgspec.Struct):
     created: datetime
 
 
+class SessionStore[U](Protocol):
+    """What an App needs from a sessions manager to resolve session cookies."""
+
+    @property
+    def session_type(self) -> Any:
+        """The type of the values the manager reads from the backend."""
+        ...
+
+    async def get_by_sessionid[D](self, sessionid: str, default: D = None) -> U | D: ...
+
+
+def type_arguments(instance: object, generic: type) -> tuple[Any, ...]:
+    """The type arguments of `generic` given to an instance.
+
+    Arguments are found on the instance of a subscripted class, like
+    Sessions[int, User](...), or on the bases of a subclass. Raise TypeError if
+    there are none: stored users would be decoded as dicts.
+    """
+    for alias in (
+        getattr(instance, "__orig_class__", None),
+        *get_original_bases(type(instance)),
+    ):
+        origin = get_origin(alias)
+        if isinstance(origin, type) and issubclass(origin, generic):
+            return get_args(alias)
+    name = generic.__name__
+    msg = (
+        f"The user id and user types of {type(instance).__name__} are unknown, "
+        f"create it as {name}[UserId, User](...) rather than annotating a "
+        f"variable with them, or pass {name}[Any, Any] to decode users as is"
+    )
+    raise TypeError(msg)
+
+
+class SessionCache[U]:
+    def __init__(
+        self,
+        ttl: float = 5.0,
+        max_entries: int = 10000,
+        sync_interval: float = 1.0,
+        shards: int = 256,
+    ) -> None:
+        """Initialize an in-process LRU cache of users by session id.
+
+        Invalidations made by other workers are picked up by polling version keys
+        in memcache at most once every `sync_interval` seconds, so a removed
+        session may be served for up to min(ttl, sync_interval) seconds. Session
+        ids are spread over `shards` version keys, all fetched in one request:
+        an invalidation only drops the cached sessions sharing its key.
+
+        Args:
+        ----
+            ttl: How long an entry is served without asking memcache, in seconds.
+            max_entries: The maximum number of cached sessions.
+            sync_interval: How often to poll the version keys, in seconds.
+            shards: The number of version keys.
+
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sync_interval = sync_interval
+        self.shards = shards
+        self.entries: OrderedDict[str, tuple[float, U]] = OrderedDict()
+        # The cached session ids of every shard.
+        self.members: list[set[str]] = [set() for _ in range(shards)]
+        # The version keys' values at the last poll, None before the first one.
+        self.versions: dict[str, int] | None = None
+        self.synced = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def shard(self, sessionid: str) -> int:
+        return zlib.crc32(sessionid.encode()) % self.shards
+
+    def get(self, sessionid: str) -> tuple[float, U] | None:
+        entry = self.entries.get(sessionid)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(sessionid)
+        self.hits += 1
+        return entry
+
+    def put(self, sessionid: str, user: U) -> None:
+        self.entries[sessionid] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(sessionid)
+        self.members[self.shard(sessionid)].add(sessionid)
+        if len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            self.members[self.shard(evicted)].discard(evicted)
+
+    def invalidate(self, sessionid: str) -> None:
+        self.entries.pop(sessionid, None)
+        self.members[self.shard(sessionid)].discard(sessionid)
+
+    def invalidate_shard(self, shard: int) -> None:
+        for sessionid in self.members[shard]:
+            self.entries.pop(sessionid, None)
+        self.members[shard].clear()
+
+
 class Sessions[T, U]:
-    def __init__(self, memcache: Memcache, expire: int = 2592000) -> None:
+    VERSION_KEY = "sessions:version"
+
+    def __init__(
+        self,
+        memcache: Backend,
+        expire: int = 2592000,
+        cache: SessionCache[U] | None = None,
+        touch_interval: float | None = None,
+        max_touched: int = 100000,
+    ) -> None:
         """Initialize a sessions manager (Implemented using memcached).
 
         Args:
         ----
-            memcache: The memcache client.
+            memcache: The memcache client, or a LocalBackend to keep sessions in
+                this process.
             expire: The expiration time of a session in seconds.
+            cache: An optional per-worker cache in front of memcache.
+            touch_interval: Make expiration sliding: a session expires `expire`
+                seconds after its last use instead of its creation. Sessions in
+                use are touched at most once per `touch_interval` seconds by
+                each worker, with a write which doesn't wait for a reply.
+            max_touched: The maximum number of sessions whose last touch is
+                remembered, sessions forgotten are touched on their next miss.
 
         """
         self.memcache = memcache
         self.expire = expire
+        self.cache = cache
+        self.version_keys = (
+            [] if cache is None else [self.version_key(i) for i in range(cache.shards)]
+        )
+        self.touch_interval = touch_interval
+        self.max_touched = max_touched
+        # When this worker last touched a session, and the session's user id.
+        self.touched: OrderedDict[str, tuple[float, T]] = OrderedDict()
+
+    @cached_property
+    def type_arguments(self) -> tuple[Any, ...]:
+        """The types T and U of Sessions[T, U] or a subclass."""
+        return type_arguments(self, Sessions)
+
+    @cached_property
+    def session_type(self) -> Any:
+        """Session specialized with the type arguments of Sessions[T, U].
+
+        Lets the serde decode stored sessions straight into the user's types.
+        """
+        userid_type, user_type = self.type_arguments
+        return Session[userid_type, user_type]
 
-    def create(self, userid: T, user: U) -> str:
-        """Create a session for user by user id.
+    def version_key(self, shard: int) -> str:
+        return f"{self.VERSION_KEY}:{shard}"
+
+    def notify(self, pipeline: BackendPipeline, sessionid: str) -> None:
+        """Queue telling the other workers to drop a session from their cache."""
+        if self.cache is None:
+            return
+        self.cache.invalidate(sessionid)
+        key = self.version_key(self.cache.shard(sessionid))
+        # Versions start from the time, not to repeat one after an eviction.
+        pipeline.add(key, time.time_ns() // 1_000_000, noreply=True)
+        pipeline.incr(key, 1, noreply=True)
+
+    async def invalidate(self, sessionid: str) -> None:
+        """Drop a session from the local cache and tell the other workers."""
+        pipeline = self.memcache.pipeline()
+        self.notify(pipeline, sessionid)
+        await pipeline.execute()
+
+    async def sync_cache(self, cache: SessionCache[U]) -> None:
+        """Drop the cached sessions of the shards other workers invalidated."""
+        now = time.monotonic()
+        if now - cache.synced < cache.sync_interval:
+            return
+        cache.synced = now
+        versions = await self.memcache.get_many(self.version_keys, as_type=int)
+        if cache.versions is not None:
+            for shard, key in enumerate(self.version_keys):
+                if versions.get(key) != cache.versions.get(key):
+                    cache.invalidate_shard(shard)
+        cache.versions = versions
+
+    async def create(self, userid: T, user: U) -> str:
+        """Create a session for user by user id, replacing the previous one.
+
+        Takes one round trip for a user without a session and two otherwise.
+        Concurrent logins of a user leave exactly one of their sessions: the
+        user id is switched to the new session with check-and-set, which fails
+        and is retried if another login switched it in between.
 
         Usage:
-        >>> response.set_session(reproca.sessions.create(...))
+        >>> credentials.set_session(await sessions.create(...))
         """
-        self.remove_by_userid(userid)
         sessionid = secrets.token_urlsafe()
-        self.memcache.set(
+        key = f"userid={userid}"
+        pipeline = self.memcache.pipeline()
+        pipeline.set(
             f"sessionid={sessionid}",
             Session(userid, user, datetime.now(tz=UTC)),
             expire=self.expire,
+            noreply=True,
         )
-        self.memcache.set(f"userid={userid}", sessionid)
+        pipeline.add(key, sessionid, expire=self.expire)
+        pipeline.gets(key, as_type=str)
+        added, (previous, cas) = await pipeline.execute()
+        while not added:
+            pipeline = self.memcache.pipeline()
+            if cas is None:
+                pipeline.add(key, sessionid, expire=self.expire)
+            else:
+                pipeline.cas(key, sessionid, cas, expire=self.expire)
+                # The previous session is replaced either by this login or by a
+                # concurrent one, it can be deleted even if the cas fails.
+                pipeline.delete(f"sessionid={previous}", noreply=True)
+                self.notify(pipeline, previous)
+            pipeline.gets(key, as_type=str)
+            added, (previous, cas) = await pipeline.execute()
         return sessionid
 
-    def update_by_sessionid(self, sessionid: str, user: U) -> None:
-        """Update a session by session id."""
-        session: Session[T, U] | None = self.memcache.get(f"sessionid={sessionid}")
-        if session is None:
-            return
-        self.memcache.replace(
-            f"sessionid={sessionid}",
-            Session(session.userid, user, session.created),
-            expire=int(
-                self.expire - (datetime.now(tz=UTC) - session.created).total_seconds()
-            ),
+    async def update_by_sessionid(self, sessionid: str, user: U) -> None:
+        """Update a session by session id.
+
+        Concurrent updates are not lost: an update made between reading and
+        writing the session fails the check-and-set and this one is retried.
+        """
+        key = f"sessionid={sessionid}"
+        session: Session[T, U] | None
+        session, cas = await self.memcache.gets(key, as_type=self.session_type)
+        while session is not None and cas is not None:
+            pipeline = self.memcache.pipeline()
+            pipeline.cas(
+                key,
+                Session(session.userid, user, session.created),
+                cas,
+                expire=self.remaining(session),
+            )
+            self.notify(pipeline, sessionid)
+            pipeline.gets(key, as_type=self.session_type)
+            stored, (session, cas) = await pipeline.execute()
+            if stored:
+                return
+
+    def remaining(self, session: Session[T, U]) -> int:
+        """The expiration time of a session rewritten now."""
+        if self.touch_interval is not None:
+            return self.expire
+        return int(
+            self.expire - (datetime.now(tz=UTC) - session.created).total_seconds()
         )
 
-    def remove_by_userid(self, userid: T) -> None:
+    async def touch(self, sessionid: str, userid: T | None = None) -> None:
+        """Extend the expiration of a session in use, if it is due.
+
+        `userid` is only needed for sessions this worker didn't touch yet.
+        """
+        interval = self.touch_interval
+        if interval is None:
+            return
+        now = time.monotonic()
+        touched = self.touched.get(sessionid)
+        if touched is not None:
+            if now - touched[0] < interval:
+                return
+            userid = touched[1]
+        elif userid is None:
+            return
+        self.touched[sessionid] = (now, userid)
+        self.touched.move_to_end(sessionid)
+        if len(self.touched) > self.max_touched:
+            self.touched.popitem(last=False)
+        pipeline = self.memcache.pipeline()
+        pipeline.touch(f"sessionid={sessionid}", self.expire, noreply=True)
+        pipeline.touch(f"userid={userid}", self.expire, noreply=True)
+        await pipeline.execute()
+
+    async def remove_by_userid(self, userid: T) -> None:
         """Remove a session by user id."""
-        sessionid: str | None = self.memcache.get(f"userid={userid}")
-        if sessionid is None:
+        key = f"userid={userid}"
+        sessionid: str | None
+        sessionid, cas = await self.memcache.gets(key, as_type=str)
+        if sessionid is None or cas is None:
             return
-        self.memcache.delete_many((f"sessionid={sessionid}", f"userid={userid}"))
+        pipeline = self.memcache.pipeline()
+        pipeline.delete(f"sessionid={sessionid}", noreply=True)
+        # Unless a concurrent login already points it to a new session.
+        pipeline.cas(key, sessionid, cas, expire=-1, noreply=True)
+        self.notify(pipeline, sessionid)
+        await pipeline.execute()
 
-    def remove_by_sessionid(self, sessionid: str) -> None:
+    async def remove_by_sessionid(self, sessionid: str) -> None:
         """Remove a session by session id."""
-        session: Session[T, U] | None = self.memcache.get(f"sessionid={sessionid}")
+        session: Session[T, U] | None = await self.memcache.get(
+            f"sessionid={sessionid}", as_type=self.session_type
+        )
         if session is None:
             return
-        self.memcache.delete_many(
-            (f"sessionid={sessionid}", f"userid={session.userid}")
-        )
+        key = f"userid={session.userid}"
+        pipeline = self.memcache.pipeline()
+        pipeline.delete(f"sessionid={sessionid}", noreply=True)
+        pipeline.gets(key, as_type=str)
+        self.notify(pipeline, sessionid)
+        [(current, cas)] = await pipeline.execute()
+        # The user may have logged in again since, keep their new session.
+        if current == sessionid and cas is not None:
+            await self.memcache.cas(key, sessionid, cas, expire=-1, noreply=True)
+
+    async def get_by_userid[D](self, userid: T, default: D = None) -> U | D:
+        """Get user by user id, return default if not found.
 
-    def get_by_userid[D](self, userid: T, default: D = None) -> U | D:
-        """Get user by user id, return default if not found."""
-        sessionid: str | None = self.memcache.get(f"userid={userid}")
+        Takes two round trips, the session id is needed to fetch the session.
+        """
+        sessionid: str | None = await self.memcache.get(f"userid={userid}", as_type=str)
         if sessionid is None:
             return default
-        session: Session[T, U] | None = self.memcache.get(f"sessionid={sessionid}")
+        session: Session[T, U] | None = await self.memcache.get(
+            f"sessionid={sessionid}", as_type=self.session_type
+        )
         if session is None:
             return default
         return session.user
 
-    def get_by_sessionid[D](self, sessionid: str, default: D = None) -> U | D:
+    async def get_by_sessionid[D](self, sessionid: str, default: D = None) -> U | D:
         """Get user by session id, return default if not found."""
-        session: Session[T, U] | None = self.memcache.get(f"sessionid={sessionid}")
+        if (cache := self.cache) is not None:
+            await self.sync_cache(cache)
+            if (entry := cache.get(sessionid)) is not None:
+                if self.touch_interval is not None:
+                    await self.touch(sessionid)
+                return entry[1]
+        session: Session[T, U] | None = await self.memcache.get(
+            f"sessionid={sessionid}", as_type=self.session_type
+        )
         if session is None:
             return default
+        if cache is not None:
+            cache.put(sessionid, session.user)
+        if self.touch_interval is not None:
+            await self.touch(sessionid, session.userid)
         return session.user
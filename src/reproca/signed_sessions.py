@@ -0,0 +1,267 @@
+"""Stateless sessions carried by HMAC-signed tokens.
+
+The session cookie holds the user itself, signed by the server, so resolving a
+session is a local signature check instead of a memcache lookup. Revocations
+are small memcache keys, one per revoked token and one per user whose tokens
+are all revoked, which expire with the tokens they revoke. Every worker checks
+the keys of a token at most once per `sync_interval`.
+"""
+
+from __future__ import annotations
+
+__all__ = ["SignedSessions", "Token"]
+
+import base64
+import binascii
+import hashlib
+import hmac
+import math
+import secrets
+import time
+from collections import OrderedDict
+from functools import cached_property
+from typing import TYPE_CHECKING, Any
+
+import msgspec
+
+from .sessions import type_arguments
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from .backend import Backend
+
+SIGNATURE_SIZE = 16
+
+
+class Token[T, U](msgspec.Struct, array_like=True):
+    # Identifies the token to revoke it.
+    id: str
+    userid: T
+    user: U
+    # Unix times. A token is revoked with the sessions of its user if it was
+    # created strictly before, so a login right after is not revoked too.
+    created_ns: int
+    expires_ms: int
+
+
+def encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+FROM_URLSAFE = bytes.maketrans(b"-_", b"+/")
+
+
+def decode(data: str) -> bytes:
+    # Twice as fast as base64.urlsafe_b64decode, extra padding is ignored.
+    return binascii.a2b_base64(data.encode().translate(FROM_URLSAFE) + b"==")
+
+
+class SignedSessions[T, U]:
+    def __init__(
+        self,
+        memcache: Backend,
+        key: bytes,
+        expire: int = 2592000,
+        sync_interval: float = 5.0,
+        previous_keys: Sequence[bytes] = (),
+        max_checked: int = 100000,
+    ) -> None:
+        """Initialize a sessions manager storing sessions in signed tokens.
+
+        Sessions are created without any round trip, and resolved with one round
+        trip per token and per user every `sync_interval` seconds, which fetches
+        their revocation keys. Removing a session revokes its token, which other
+        workers honor after up to `sync_interval` seconds. A user can have
+        several sessions, logging in doesn't end the previous one, and sessions
+        can't be looked up by user id nor updated: `reissue` returns a new token
+        instead.
+
+        Revocations only live in memcache: if memcache evicts or loses a
+        revocation key, the tokens it revoked are accepted again until they
+        expire, at most `expire` seconds. Give memcache enough memory not to
+        evict, or keep `expire` short and `reissue` tokens in use.
+
+        Usage:
+        >>> sessions = SignedSessions[int, User](memcache, key=os.urandom(32))
+
+        Args:
+        ----
+            memcache: The memcache client, only used for revocations.
+            key: The secret key signing the tokens, shared by all workers.
+            expire: The expiration time of a token in seconds, at most 30 days.
+            sync_interval: How long the revocation keys of a token fetched by
+                this worker are trusted, in seconds.
+            previous_keys: Keys which signed tokens that are still accepted,
+                to rotate the key without ending all the sessions.
+            max_checked: The maximum number of tokens and of users whose
+                revocation keys are remembered.
+
+        """
+        self.memcache = memcache
+        self.expire = expire
+        # HMACs keyed once, copied to sign.
+        self.macs = [
+            hmac.new(key, digestmod=hashlib.sha256) for key in (key, *previous_keys)
+        ]
+        self.sync_interval = sync_interval
+        self.max_checked = max_checked
+        # Until when the fetched revocation keys are trusted, and whether the
+        # token is revoked or the time before which the user's tokens are.
+        self.tokens: OrderedDict[str, tuple[float, bool]] = OrderedDict()
+        self.users: OrderedDict[str, tuple[float, int]] = OrderedDict()
+
+    @cached_property
+    def token_type(self) -> Any:
+        userid_type, user_type = type_arguments(self, SignedSessions)
+        return Token[userid_type, user_type]
+
+    @property
+    def session_type(self) -> Any:
+        """The revocation keys are the only values read from memcache.
+
+        Also resolves the token type, which raises TypeError if the type
+        arguments are unknown.
+        """
+        _ = self.token_type
+        return int
+
+    @cached_property
+    def encoder(self) -> msgspec.msgpack.Encoder:
+        return msgspec.msgpack.Encoder()
+
+    @cached_property
+    def decoder(self) -> msgspec.msgpack.Decoder[Any]:
+        return msgspec.msgpack.Decoder(self.token_type)
+
+    def sign(self, payload: bytes, index: int = 0) -> bytes:
+        """Sign with the current key or with the previous key at `index` - 1."""
+        mac = self.macs[index].copy()
+        mac.update(payload)
+        return mac.digest()[:SIGNATURE_SIZE]
+
+    def issue(self, userid: T, user: U, expires_ms: int | None = None) -> str:
+        created_ns = time.time_ns()
+        if expires_ms is None:
+            expires_ms = created_ns // 1_000_000 + self.expire * 1000
+        token = Token(secrets.token_urlsafe(9), userid, user, created_ns, expires_ms)
+        payload = self.encoder.encode(token)
+        return f"{encode(payload)}.{encode(self.sign(payload))}"
+
+    def verify(self, sessionid: str) -> Token[T, U] | None:
+        """Return the token if it is authentic and not expired, else None."""
+        encoded, _, signature = sessionid.partition(".")
+        try:
+            payload = decode(encoded)
+            signature_bytes = decode(signature)
+        except ValueError:
+            return None
+        if not any(
+            hmac.compare_digest(signature_bytes, self.sign(payload, index))
+            for index in range(len(self.macs))
+        ):
+            return None
+        try:
+            token: Token[T, U] = self.decoder.decode(payload)
+        except msgspec.DecodeError:
+            return None
+        if token.expires_ms <= time.time_ns() // 1_000_000:
+            return None
+        return token
+
+    def remember[V](
+        self, checked: OrderedDict[str, tuple[float, V]], key: str, value: V
+    ) -> None:
+        checked[key] = (time.monotonic() + self.sync_interval, value)
+        checked.move_to_end(key)
+        if len(checked) > self.max_checked:
+            checked.popitem(last=False)
+
+    async def revoked(self, token: Token[T, U]) -> bool:
+        """Return whether a token is revoked, fetching its stale revocation keys."""
+        userid = str(token.userid)
+        token_key = f"revoked:token={token.id}"
+        user_key = f"revoked:userid={userid}"
+        now = time.monotonic()
+        checked_token = self.tokens.get(token.id)
+        checked_user = self.users.get(userid)
+        keys = [
+            key
+            for key, checked in ((token_key, checked_token), (user_key, checked_user))
+            if checked is None or checked[0] <= now
+        ]
+        revocations = await self.memcache.get_many(keys, as_type=int) if keys else {}
+        if checked_token is None or token_key in keys:
+            self.remember(self.tokens, token.id, token_key in revocations)
+        if checked_user is None or user_key in keys:
+            self.remember(self.users, userid, revocations.get(user_key, 0))
+        return self.tokens[token.id][1] or token.created_ns < self.users[userid][1]
+
+    async def revoke_token(self, token: Token[T, U]) -> None:
+        """Revoke a token until it expires."""
+        expire = math.ceil((token.expires_ms - time.time_ns() // 1_000_000) / 1000)
+        if expire > 0:
+            await self.memcache.set(f"revoked:token={token.id}", 1, expire=expire)
+        self.remember(self.tokens, token.id, True)
+
+    async def revoke_userid(self, userid: T) -> None:
+        """Revoke the tokens of a user created so far.
+
+        The revocation time only moves forward, a concurrent revocation which
+        started earlier can't overwrite it: it is updated with check-and-set.
+        """
+        now_ns = time.time_ns()
+        key = f"revoked:userid={userid}"
+        pipeline = self.memcache.pipeline()
+        pipeline.add(key, now_ns, expire=self.expire)
+        pipeline.gets(key, as_type=int)
+        added, (revoked_ns, cas) = await pipeline.execute()
+        while not added and (revoked_ns is None or revoked_ns < now_ns):
+            pipeline = self.memcache.pipeline()
+            if cas is None:
+                pipeline.add(key, now_ns, expire=self.expire)
+            else:
+                pipeline.cas(key, now_ns, cas, expire=self.expire)
+            pipeline.gets(key, as_type=int)
+            added, (revoked_ns, cas) = await pipeline.execute()
+        self.remember(self.users, str(userid), max(now_ns, revoked_ns or 0))
+
+    async def create(self, userid: T, user: U) -> str:
+        """Create a session for user by user id, without any round trip.
+
+        Usage:
+        >>> credentials.set_session(await sessions.create(...))
+        """
+        return self.issue(userid, user)
+
+    async def reissue(self, sessionid: str, user: U) -> str | None:
+        """Return a new token for the session with an updated user.
+
+        The old token is revoked and the new one expires when it would have.
+        Returns None if the session is not valid.
+
+        Usage:
+        >>> credentials.set_session(await sessions.reissue(sessionid, user))
+        """
+        token = self.verify(sessionid)
+        if token is None or await self.revoked(token):
+            return None
+        await self.revoke_token(token)
+        return self.issue(token.userid, user, token.expires_ms)
+
+    async def remove_by_userid(self, userid: T) -> None:
+        """Revoke all the sessions of a user created so far."""
+        await self.revoke_userid(userid)
+
+    async def remove_by_sessionid(self, sessionid: str) -> None:
+        """Revoke a session by session id."""
+        token = self.verify(sessionid)
+        if token is not None:
+            await self.revoke_token(token)
+
+    async def get_by_sessionid[D](self, sessionid: str, default: D = None) -> U | D:
+        """Get user by session id, return default if not found or revoked."""
+        token = self.verify(sessionid)
+        if token is None or await self.revoked(token):
+            return default
+        return token.user
@@ -0,0 +1,147 @@
+"""Incremental reading of request bodies and streaming of responses."""
+
+from __future__ import annotations
+
+__all__ = [
+    "BodyTooLargeError",
+    "DisconnectedError",
+    "RequestBody",
+    "ndjson",
+    "read_body",
+]
+
+import asyncio
+from contextlib import aclosing
+from typing import TYPE_CHECKING, Any
+
+import msgspec
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, AsyncIterator
+
+    from .asgi.types import ASGIReceiveCallable
+
+encoder = msgspec.json.Encoder()
+
+
+class DisconnectedError(Exception):
+    """The client disconnected before the request body was received."""
+
+
+class BodyTooLargeError(Exception):
+    """The request body is larger than the method allows."""
+
+
+class RequestBody:
+    """The body of a request as an async iterator of chunks.
+
+    Declare a parameter of this type to consume the body without buffering it:
+    >>> @method(max_body_size=2**30)
+    ... async def upload(name: str, body: RequestBody) -> None:
+    ...     async for chunk in body:
+    ...         ...
+
+    Other parameters of such a method are read from the URL-encoded JSON query
+    string instead of the body.
+    """
+
+    def __init__(self, receive: ASGIReceiveCallable, limit: int) -> None:
+        self.receive = receive
+        self.limit = limit
+        self.received = 0
+        self.done = False
+
+    def __aiter__(self) -> RequestBody:
+        return self
+
+    async def __anext__(self) -> bytes:
+        while not self.done:
+            event = await self.receive()
+            if event["type"] != "http.request":
+                raise DisconnectedError
+            self.done = not event.get("more_body", False)
+            chunk = event["body"]
+            self.received += len(chunk)
+            if self.received > self.limit:
+                raise BodyTooLargeError
+            if chunk:
+                return chunk
+        raise StopAsyncIteration
+
+
+async def read_body(
+    receive: ASGIReceiveCallable, content_length: int | None, limit: int
+) -> bytes | bytearray:
+    """Read a whole request body of at most `limit` bytes.
+
+    A body sent in several chunks is copied into a buffer preallocated from the
+    Content-Length header, a body sent in one chunk is returned without copying.
+    """
+    event = await receive()
+    if event["type"] != "http.request":
+        raise DisconnectedError
+    chunk = event["body"]
+    if len(chunk) > limit:
+        raise BodyTooLargeError
+    if not event.get("more_body", False):
+        return chunk
+    if content_length is None:
+        chunks = [chunk]
+        async for part in RequestBody(receive, limit - len(chunk)):
+            chunks.append(part)
+        return b"".join(chunks)
+    if len(chunk) > content_length:
+        raise BodyTooLargeError
+    buffer = bytearray(content_length)
+    with memoryview(buffer) as view:
+        view[: len(chunk)] = chunk
+        received = len(chunk)
+        async for part in RequestBody(receive, content_length - received):
+            view[received : received + len(part)] = part
+            received += len(part)
+    del buffer[received:]
+    return buffer
+
+
+async def ndjson(
+    items: AsyncGenerator[Any, None], chunk_size: int = 65536, max_pending: int = 256
+) -> AsyncIterator[bytes]:
+    """Encode the items of an async generator as newline-delimited JSON chunks.
+
+    The items are produced in a separate task into a queue of at most
+    `max_pending` items. Items which are ready are encoded together into chunks of
+    about `chunk_size` bytes, an item which took a while to produce is sent on its
+    own right away. A slow client stops the consumer, which fills the queue, which
+    stops the producer.
+    """
+    queue: asyncio.Queue[tuple[bool, Any]] = asyncio.Queue(max_pending)
+
+    async def produce() -> None:
+        async with aclosing(items):
+            try:
+                async for item in items:
+                    await queue.put((False, item))
+            except Exception as e:  # noqa: BLE001
+                await queue.put((True, e))
+                return
+        await queue.put((True, None))
+
+    task = asyncio.create_task(produce())
+    buffer = bytearray()
+    try:
+        done, item = await queue.get()
+        while not done:
+            encoder.encode_into(item, buffer, -1)
+            buffer.extend(b"\n")
+            if len(buffer) >= chunk_size or queue.empty():
+                yield bytes(buffer)
+                buffer.clear()
+                done, item = await queue.get()
+            else:
+                done, item = queue.get_nowait()
+        if item is not None:
+            raise item
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        task.cancel()
@@ -0,0 +1,89 @@
+"""Timing of the phases of a request, reported in a Server-Timing header."""
+
+from __future__ import annotations
+
+__all__ = ["Span", "SpanHook", "Trace", "Tracer"]
+
+import random
+from time import perf_counter_ns
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Sequence
+
+
+class Span(NamedTuple):
+    name: str
+    start_ns: int
+    end_ns: int
+
+
+type SpanHook = Callable[[str, Sequence[Span]], None]
+
+
+class Trace:
+    """The spans of one traced request."""
+
+    __slots__ = ("spans",)
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+
+    def add(self, name: str, start_ns: int) -> int:
+        """Add a span from `start_ns` to now, return now to start the next one."""
+        end_ns = perf_counter_ns()
+        self.spans.append(Span(name, start_ns, end_ns))
+        return end_ns
+
+    def server_timing(self) -> bytes:
+        return ", ".join(
+            f"{span.name};dur={(span.end_ns - span.start_ns) / 1e6:.3f}"
+            for span in self.spans
+        ).encode()
+
+
+class Tracer:
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        header: bytes | None = b"x-reproca-trace",
+        hooks: Sequence[SpanHook] = (),
+        *,
+        server_timing: bool = True,
+    ) -> None:
+        """Initialize a tracer timing the phases of sampled requests.
+
+        The phases are cookie parsing, rate limiting, session lookup, parameter
+        decoding, the method itself, result encoding and compression. Requests
+        which are not traced only pay for a few `is None` checks.
+
+        Usage:
+        >>> app = App(sessions, memcache, tracer=Tracer(0.01, hooks=[export]))
+
+        Args:
+        ----
+            sample_rate: The fraction of requests traced at random.
+            header: A request header which traces the request when present,
+                whatever the sample rate.
+            hooks: Functions called with the path and the spans of every traced
+                request once its response is sent, to forward them to a tracer.
+            server_timing: Report the spans of traced requests in a
+                Server-Timing response header.
+
+        """
+        self.sample_rate = sample_rate
+        self.header = header
+        self.hooks = hooks
+        self.server_timing = server_timing
+
+    def start(self, headers: dict[bytes, bytes]) -> Trace | None:
+        """Return a trace if the request is traced, else None."""
+        if (self.header is not None and self.header in headers) or (
+            self.sample_rate and random.random() < self.sample_rate  # noqa: S311
+        ):
+            return Trace()
+        return None
+
+    def finish(self, path: str, trace: Trace) -> None:
+        for hook in self.hooks:
+            hook(path, trace.spans)
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import shutil
+import socket
+import subprocess
+import time
+from typing import TYPE_CHECKING
+
+import pytest
+
+from .memcached import MemcachedServer
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def memcached() -> Iterator[tuple[str, int]]:
+    """Yield the address of an empty memcached, the real one if installed."""
+    binary = shutil.which("memcached")
+    if binary is None:
+        server = MemcachedServer()
+        yield server.start()
+        server.stop()
+        return
+    port = free_port()
+    process = subprocess.Popen([binary, "-l", "127.0.0.1", "-p", str(port)])  # noqa: S603
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+        yield ("127.0.0.1", port)
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,179 @@
+"""A minimal memcached speaking the text protocol, for tests and benchmarks.
+
+Implements the commands the reproca client sends, with CAS tokens and
+expiration times. `Memcached` answers complete requests in memory, and
+`MemcachedServer` serves it on an event loop running in a background thread
+for tests without a memcached binary.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import threading
+import time
+
+STORAGE_COMMANDS = {b"set", b"add", b"replace", b"cas"}
+
+
+class Item:
+    def __init__(self, flags: int, data: bytes, deadline: float, cas: int) -> None:
+        self.flags = flags
+        self.data = data
+        self.deadline = deadline
+        self.cas = cas
+
+
+class Memcached:
+    def __init__(self) -> None:
+        self.items: dict[bytes, Item] = {}
+        self.tokens = itertools.count(1)
+
+    def lookup(self, key: bytes) -> Item | None:
+        item = self.items.get(key)
+        if item is not None and item.deadline and item.deadline <= time.monotonic():
+            del self.items[key]
+            return None
+        return item
+
+    @staticmethod
+    def deadline(expire: bytes) -> float:
+        seconds = int(expire)
+        if seconds == 0:
+            return 0.0
+        # A negative expiration time expires the item at once.
+        return time.monotonic() + seconds if seconds > 0 else -1.0
+
+    def reply(self, payload: bytes) -> bytes:
+        """Answer the complete commands of a request, pipelined or not."""
+        replies: list[bytes] = []
+        view = memoryview(payload)
+        position = 0
+        while position < len(payload):
+            end = payload.index(b"\r\n", position)
+            command, *args = bytes(view[position:end]).split()
+            position = end + 2
+            noreply = args[-1:] == [b"noreply"]
+            if noreply:
+                args.pop()
+            if command in STORAGE_COMMANDS:
+                length = int(args[3])
+                reply = self.store(
+                    command, args, bytes(view[position : position + length])
+                )
+                position += length + 2
+            else:
+                reply = self.execute(command, args)
+            if not noreply:
+                replies.append(reply)
+        return b"".join(replies)
+
+    def store(self, command: bytes, args: list[bytes], data: bytes) -> bytes:
+        key, flags, expire = args[0], int(args[1]), args[2]
+        current = self.lookup(key)
+        if command == b"add" and current is not None:
+            return b"NOT_STORED\r\n"
+        if command == b"replace" and current is None:
+            return b"NOT_STORED\r\n"
+        if command == b"cas":
+            if current is None:
+                return b"NOT_FOUND\r\n"
+            if current.cas != int(args[4]):
+                return b"EXISTS\r\n"
+        self.items[key] = Item(flags, data, self.deadline(expire), next(self.tokens))
+        return b"STORED\r\n"
+
+    def execute(self, command: bytes, args: list[bytes]) -> bytes:
+        match command:
+            case b"get" | b"gets":
+                reply = b""
+                for key in args:
+                    item = self.lookup(key)
+                    if item is None:
+                        continue
+                    header = b"VALUE %s %d %d" % (key, item.flags, len(item.data))
+                    if command == b"gets":
+                        header += b" %d" % item.cas
+                    reply += header + b"\r\n" + item.data + b"\r\n"
+                return reply + b"END\r\n"
+            case b"incr" | b"decr":
+                item = self.lookup(args[0])
+                if item is None:
+                    return b"NOT_FOUND\r\n"
+                delta = int(args[1]) if command == b"incr" else -int(args[1])
+                value = max(0, int(item.data) + delta)
+                item.data = b"%d" % value
+                item.cas = next(self.tokens)
+                return b"%d\r\n" % value
+            case b"delete":
+                if self.lookup(args[0]) is None:
+                    return b"NOT_FOUND\r\n"
+                del self.items[args[0]]
+                return b"DELETED\r\n"
+            case b"touch":
+                item = self.lookup(args[0])
+                if item is None:
+                    return b"NOT_FOUND\r\n"
+                item.deadline = self.deadline(args[1])
+                return b"TOUCHED\r\n"
+            case b"version":
+                return b"VERSION 1.6.0\r\n"
+            case _:
+                return b"ERROR\r\n"
+
+
+class MemcachedServer:
+    def __init__(self) -> None:
+        self.memcached = Memcached()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.server: asyncio.Server | None = None
+        # The connection handlers, by the writer of their connection.
+        self.clients: dict[asyncio.StreamWriter, asyncio.Task[None]] = {}
+
+    def start(self) -> tuple[str, int]:
+        """Listen on a free port of localhost, return the address."""
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle, "127.0.0.1", 0), self.loop
+        ).result()
+        return self.server.sockets[0].getsockname()[:2]
+
+    def stop(self) -> None:
+        """Close the server and the connections of its clients."""
+
+        async def close() -> None:
+            assert self.server is not None
+            self.server.close()
+            # The handlers read the end of their stream and return.
+            for writer in self.clients:
+                writer.close()
+            await asyncio.gather(*self.clients.values(), return_exceptions=True)
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        client = asyncio.current_task()
+        assert client is not None
+        self.clients[writer] = client
+        try:
+            while line := await reader.readline():
+                request = line
+                command, *args = line.split()
+                if command in STORAGE_COMMANDS:
+                    request += await reader.readexactly(int(args[3]) + 2)
+                if reply := self.memcached.reply(request):
+                    writer.write(reply)
+                    await writer.drain()
+        finally:
+            del self.clients[writer]
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
@@ -0,0 +1,41 @@
+"""Replies of memcached which don't match the requests."""
+
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from reproca.memcache import Memcache, MemcacheError
+
+
+async def reply_other_key(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Answer every request with the value of another key."""
+    while await reader.readline():
+        writer.write(b"VALUE other 0 1\r\nx\r\nEND\r\n")
+        await writer.drain()
+    writer.close()
+
+
+def test_reply_for_another_key_drops_connection() -> None:
+    async def main() -> None:
+        server = await asyncio.start_server(reply_other_key, "127.0.0.1", 0)
+        memcache = Memcache(server.sockets[0].getsockname()[:2])
+        try:
+            with pytest.raises(MemcacheError, match="out of sync"):
+                await memcache.get("key")
+            assert memcache.connections == []
+            with pytest.raises(MemcacheError, match="out of sync"):
+                await memcache.get_many(["key", "another"])
+            pipeline = memcache.pipeline()
+            pipeline.gets("key")
+            with pytest.raises(MemcacheError, match="out of sync"):
+                await pipeline.execute()
+        finally:
+            await memcache.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(main())
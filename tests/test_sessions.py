@@ -0,0 +1,162 @@
+"""Round trips of Sessions operations against memcached."""
+
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+import msgspec
+import pytest
+
+from reproca.backend import LocalBackend
+from reproca.memcache import Memcache
+from reproca.sessions import SessionCache, Sessions
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+
+class User(msgspec.Struct):
+    name: str
+
+
+async def round_trips[R](
+    memcache: Memcache, operation: Callable[[], Awaitable[R]]
+) -> tuple[int, R]:
+    """Return the round trips an operation took, and its result."""
+    before = memcache.round_trips
+    result = await operation()
+    return memcache.round_trips - before, result
+
+
+def run(
+    address: tuple[str, int],
+    test: Callable[[Memcache, Sessions[int, User]], Awaitable[None]],
+) -> None:
+    async def main() -> None:
+        memcache = Memcache(address)
+        try:
+            await test(memcache, Sessions[int, User](memcache))
+        finally:
+            await memcache.close()
+
+    asyncio.run(main())
+
+
+def test_create_new_user(memcached: tuple[str, int]) -> None:
+    async def test(memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        trips, sessionid = await round_trips(
+            memcache, lambda: sessions.create(1, User("alice"))
+        )
+        assert trips == 1
+        assert await sessions.get_by_sessionid(sessionid) == User("alice")
+
+    run(memcached, test)
+
+
+def test_create_replaces_session(memcached: tuple[str, int]) -> None:
+    async def test(memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        previous = await sessions.create(1, User("alice"))
+        trips, sessionid = await round_trips(
+            memcache, lambda: sessions.create(1, User("alice"))
+        )
+        assert trips == 2
+        assert await sessions.get_by_sessionid(previous) is None
+        assert await sessions.get_by_sessionid(sessionid) == User("alice")
+
+    run(memcached, test)
+
+
+def test_concurrent_creates_leave_one_session(memcached: tuple[str, int]) -> None:
+    async def test(_memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        sessionids = await asyncio.gather(
+            *(sessions.create(1, User(f"alice {i}")) for i in range(10))
+        )
+        users = [await sessions.get_by_sessionid(s) for s in sessionids]
+        live = [user for user in users if user is not None]
+        assert len(live) == 1
+        assert await sessions.get_by_userid(1) == live[0]
+
+    run(memcached, test)
+
+
+def test_update_by_sessionid(memcached: tuple[str, int]) -> None:
+    async def test(memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        sessionid = await sessions.create(1, User("alice"))
+        trips, _ = await round_trips(
+            memcache, lambda: sessions.update_by_sessionid(sessionid, User("bob"))
+        )
+        assert trips == 2
+        assert await sessions.get_by_sessionid(sessionid) == User("bob")
+
+    run(memcached, test)
+
+
+def test_remove_by_userid(memcached: tuple[str, int]) -> None:
+    async def test(memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        sessionid = await sessions.create(1, User("alice"))
+        trips, _ = await round_trips(memcache, lambda: sessions.remove_by_userid(1))
+        assert trips == 1
+        assert await sessions.get_by_sessionid(sessionid) is None
+        assert await sessions.get_by_userid(1) is None
+
+    run(memcached, test)
+
+
+def test_remove_by_sessionid(memcached: tuple[str, int]) -> None:
+    async def test(memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        sessionid = await sessions.create(1, User("alice"))
+        trips, _ = await round_trips(
+            memcache, lambda: sessions.remove_by_sessionid(sessionid)
+        )
+        assert trips == 2
+        assert await sessions.get_by_sessionid(sessionid) is None
+        assert await sessions.get_by_userid(1) is None
+
+    run(memcached, test)
+
+
+def test_get_by_userid(memcached: tuple[str, int]) -> None:
+    async def test(memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        await sessions.create(1, User("alice"))
+        trips, user = await round_trips(memcache, lambda: sessions.get_by_userid(1))
+        assert trips == 2
+        assert user == User("alice")
+
+    run(memcached, test)
+
+
+def test_session_type_from_subclass() -> None:
+    class UserSessions(Sessions[int, User]):
+        pass
+
+    sessions = UserSessions(LocalBackend())
+    assert sessions.type_arguments == (int, User)
+
+
+def test_session_type_unknown() -> None:
+    sessions: Sessions[int, User] = Sessions(LocalBackend())
+    with pytest.raises(TypeError, match=r"Sessions\[UserId, User\]"):
+        _ = sessions.session_type
+
+
+def test_cache_drops_only_invalidated_sessions(memcached: tuple[str, int]) -> None:
+    async def test(memcache: Memcache, sessions: Sessions[int, User]) -> None:
+        cache = SessionCache[User](ttl=60, sync_interval=0)
+        worker = Sessions[int, User](memcache, cache=cache)
+        sessionids = [await sessions.create(i, User(f"user {i}")) for i in range(20)]
+        for sessionid in sessionids:
+            await worker.get_by_sessionid(sessionid)
+        # Only workers with a cache notify the others.
+        writer = Sessions[int, User](memcache, cache=SessionCache[User]())
+        await writer.update_by_sessionid(sessionids[0], User("bob"))
+        assert await worker.get_by_sessionid(sessionids[0]) == User("bob")
+        misses = cache.misses
+        for sessionid in sessionids[1:]:
+            await worker.get_by_sessionid(sessionid)
+        shard = cache.shard(sessionids[0])
+        assert cache.misses - misses == sum(
+            cache.shard(sessionid) == shard for sessionid in sessionids[1:]
+        )
+
+    run(memcached, test)
@@ -0,0 +1,101 @@
+"""Revocations of SignedSessions tokens against memcached."""
+
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+import msgspec
+
+from reproca.backend import LocalBackend
+from reproca.memcache import Memcache
+from reproca.signed_sessions import SignedSessions
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from reproca.backend import Backend
+
+
+class User(msgspec.Struct):
+    name: str
+
+
+def run(
+    address: tuple[str, int] | None,
+    test: Callable[[SignedSessions[int, User]], Awaitable[None]],
+) -> None:
+    """Run a test against memcached, or against a LocalBackend if no address."""
+
+    async def main() -> None:
+        memcache: Backend = LocalBackend() if address is None else Memcache(address)
+        try:
+            await test(
+                SignedSessions[int, User](memcache, key=b"k" * 32, sync_interval=0)
+            )
+        finally:
+            await memcache.close()
+
+    asyncio.run(main())
+
+
+def test_remove_by_sessionid(memcached: tuple[str, int]) -> None:
+    async def test(sessions: SignedSessions[int, User]) -> None:
+        sessionid = await sessions.create(1, User("alice"))
+        other = await sessions.create(1, User("alice"))
+        await sessions.remove_by_sessionid(sessionid)
+        assert await sessions.get_by_sessionid(sessionid) is None
+        assert await sessions.get_by_sessionid(other) == User("alice")
+
+    run(memcached, test)
+
+
+def test_remove_by_userid(memcached: tuple[str, int]) -> None:
+    async def test(sessions: SignedSessions[int, User]) -> None:
+        sessionids = [await sessions.create(1, User("alice")) for _ in range(3)]
+        other = await sessions.create(2, User("bob"))
+        await sessions.remove_by_userid(1)
+        for sessionid in sessionids:
+            assert await sessions.get_by_sessionid(sessionid) is None
+        assert await sessions.get_by_sessionid(other) == User("bob")
+
+    run(memcached, test)
+
+
+def test_login_right_after_remove_by_userid() -> None:
+    async def test(sessions: SignedSessions[int, User]) -> None:
+        previous = await sessions.create(1, User("alice"))
+        await sessions.remove_by_userid(1)
+        sessionids = [await sessions.create(1, User("alice")) for _ in range(200)]
+        assert await sessions.get_by_sessionid(previous) is None
+        for sessionid in sessionids:
+            assert await sessions.get_by_sessionid(sessionid) == User("alice")
+
+    # Without a network round trip, logins happen within the revocation's
+    # millisecond.
+    run(None, test)
+
+
+def test_new_worker_honors_revocations(memcached: tuple[str, int]) -> None:
+    async def test(sessions: SignedSessions[int, User]) -> None:
+        revoked = await sessions.create(1, User("alice"))
+        revoked_user = await sessions.create(2, User("bob"))
+        await sessions.remove_by_sessionid(revoked)
+        await sessions.remove_by_userid(2)
+        worker = SignedSessions[int, User](sessions.memcache, key=b"k" * 32)
+        assert await worker.get_by_sessionid(revoked) is None
+        assert await worker.get_by_sessionid(revoked_user) is None
+
+    run(memcached, test)
+
+
+def test_reissue(memcached: tuple[str, int]) -> None:
+    async def test(sessions: SignedSessions[int, User]) -> None:
+        sessionid = await sessions.create(1, User("alice"))
+        reissued = await sessions.reissue(sessionid, User("bob"))
+        assert reissued is not None
+        assert await sessions.get_by_sessionid(sessionid) is None
+        assert await sessions.get_by_sessionid(reissued) == User("bob")
+        assert await sessions.reissue(sessionid, User("eve")) is None
+
+    run(memcached, test)